@@ -0,0 +1,143 @@
+import glob
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+BBox = Tuple[int, int, int, int]
+
+
+class Backend(ABC):
+    @abstractmethod
+    def grab(self, bbox: Optional[BBox] = None) -> Image.Image:
+        ...
+
+    @abstractmethod
+    def move(self, xy: Tuple[int, int]):
+        ...
+
+    @abstractmethod
+    def press(self):
+        ...
+
+    @abstractmethod
+    def release(self):
+        ...
+
+    @abstractmethod
+    def wait_for_click(self) -> Tuple[int, int]:
+        ...
+
+    def click(self, xy: Tuple[int, int], hold: float = 0.0):
+        self.move(xy)
+        self.press()
+        if hold:
+            time.sleep(hold)
+        self.release()
+
+    def settings(self, screen: str) -> Optional[Dict]:
+        # a backend that knows its own layout can skip calibration, the live screen never does
+        return None
+
+
+class LiveBackend(Backend):
+    def __init__(self):
+        # only touch the display server once the live screen is actually used
+        from PIL import ImageGrab
+        from pynput import mouse
+
+        self.image_grab = ImageGrab
+        self.mouse = mouse
+        self.controller = mouse.Controller()
+
+    def grab(self, bbox: Optional[BBox] = None) -> Image.Image:
+        return self.image_grab.grab(bbox=bbox)
+
+    def move(self, xy: Tuple[int, int]):
+        self.controller.position = xy
+
+    def press(self):
+        self.controller.press(self.mouse.Button.left)
+
+    def release(self):
+        self.controller.release(self.mouse.Button.left)
+
+    def wait_for_click(self) -> Tuple[int, int]:
+        last_pressed: Tuple[int, int] = (-1, -1)
+
+        def on_click(x, y, button, pressed):
+            nonlocal last_pressed
+            if pressed:
+                last_pressed = (x, y)
+                return False
+
+        with self.mouse.Listener(on_click=on_click) as listener:
+            listener.join()
+        return last_pressed
+
+
+class RecordedBackend(Backend):
+    def __init__(self, frames: List[Image.Image], layout: Optional[Dict] = None):
+        self.frames = [frame.convert('RGB') for frame in frames]
+        self.layout = layout
+        self.grabs = 0
+
+    @classmethod
+    def load(cls, directory: str) -> 'RecordedBackend':
+        paths = sorted(glob.glob(os.path.join(directory, 'frame_*.png')))
+        if not paths:
+            raise FileNotFoundError(f'No recorded frames in {directory}')
+        layout = None
+        layout_path = os.path.join(directory, 'layout.json')
+        if os.path.exists(layout_path):
+            with open(layout_path, 'r') as f:
+                layout = json.load(f)
+        return cls([Image.open(p) for p in paths], layout)
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for i, frame in enumerate(self.frames):
+            frame.save(os.path.join(directory, f'frame_{i:03}.png'))
+        if self.layout is not None:
+            with open(os.path.join(directory, 'layout.json'), 'w') as f:
+                json.dump(self.layout, f)
+
+    def grab(self, bbox: Optional[BBox] = None) -> Image.Image:
+        # step through the recording so consecutive grabs see different frames
+        frame = self.frames[self.grabs % len(self.frames)]
+        self.grabs += 1
+        return frame.crop(bbox) if bbox else frame.copy()
+
+    # a recording cannot react, clicks go nowhere
+    def move(self, xy: Tuple[int, int]):
+        pass
+
+    def press(self):
+        pass
+
+    def release(self):
+        pass
+
+    def wait_for_click(self) -> Tuple[int, int]:
+        raise RuntimeError('Nobody can click on a recording, save its layout with the frames')
+
+    def settings(self, screen: str) -> Optional[Dict]:
+        return self.layout if screen == 'input' else None
+
+
+_backend: Optional[Backend] = None
+
+
+def get_backend() -> Backend:
+    global _backend
+    if _backend is None:
+        _backend = LiveBackend()
+    return _backend
+
+
+def set_backend(backend: Backend):
+    global _backend
+    _backend = backend
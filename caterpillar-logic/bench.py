@@ -0,0 +1,226 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import timeit
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from backend import RecordedBackend, get_backend, set_backend
+from common import DATA_DIR, MAX_CATERPILLAR_SIZE, Caterpillar, InputScreen, load_results
+from dataset import load_dataset
+
+BENCH_DIR = os.path.join(DATA_DIR, 'bench')
+FRAMES_DIR = os.path.join(BENCH_DIR, 'frames')
+RESULTS_FILE = os.path.join(BENCH_DIR, 'results.json')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+GROUPS = ['startup', 'screen', 'sampling', 'loading', 'train', 'inference']
+LEVELS = ['1', '2', '13']
+REPEAT = 5
+TRAIN_EPOCHS = 3
+INFERENCE_BATCH = 1024
+ENTRY_POINTS = ['common', 'curate', 'nn', 'play', 'serve', 'sim', 'bench', 'rules', 'train_batch', 'dataset', 'layout',
+                'metrics']
+# changes smaller than this are noise on a shared machine
+NOISE = 0.05
+
+
+def measure(fn: Callable, repeat: int = REPEAT, number: Optional[int] = None) -> float:
+    # best seconds per call, the minimum is the least disturbed by everything else on the machine
+    timer = timeit.Timer(fn)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def bench_startup() -> Dict[str, float]:
+    # a fresh interpreter per run, importing a module in this process would only time the first import
+    def start(code: str) -> Callable[[], None]:
+        return lambda: subprocess.run([sys.executable, '-c', code], check=True,
+                                      cwd=os.path.dirname(os.path.realpath(__file__)))
+
+    results = {'startup/python': measure(start('pass'), number=1)}
+    for module in ENTRY_POINTS:
+        results[f'startup/{module}'] = measure(start(f'import {module}'), number=1)
+    return results
+
+
+def bench_screen() -> Dict[str, float]:
+    set_backend(RecordedBackend.load(FRAMES_DIR))
+    screen = InputScreen()
+    screen.init()
+    snapshot = screen.snapshot()
+    locs = [loc + offset for offset in screen.cat_offsets for loc in screen.valid_loc + screen.invalid_loc]
+    return {
+        'screen/get_color per segment': measure(
+            lambda: [loc.get_color(screen.color_lookup, snapshot) for loc in locs]) / len(locs),
+        'screen/classify per segment': measure(lambda: screen.classifier.classify(snapshot.sample(locs))) / len(locs),
+        'screen/snapshot': measure(screen.snapshot),
+        'screen/read_caterpillars per frame': measure(lambda: screen.read_caterpillars(screen.snapshot())),
+    }
+
+
+def bench_sampling() -> Dict[str, float]:
+    import curate
+    from space import CaterpillarSpace
+
+    space = CaterpillarSpace()
+    return {
+        'sampling/gen_space': measure(curate.gen_space),
+        'sampling/stratified_sample': measure(
+            lambda: space.stratified_sample(curate.DEFAULT_THRESH, 2, np.random.default_rng(0))),
+    }
+
+
+def bench_loading() -> Dict[str, float]:
+    results = {}
+    for name in LEVELS:
+        path = os.path.join(DATA_DIR, f'{name}.json')
+        results[f'loading/json {name}'] = measure(lambda: load_results(path))
+        # converts once if needed, then times the packed format the trainers actually read
+        load_dataset(name)
+        results[f'loading/packed {name}'] = measure(lambda: np.array(load_dataset(name).segments))
+    return results
+
+
+def bench_train() -> Dict[str, float]:
+    import nn
+    import torch
+
+    results = {}
+    for name in LEVELS:
+        data = load_dataset(name)
+        segments, labels = np.array(data.segments), data.labels
+        torch.manual_seed(0)
+        seconds = measure(lambda: nn.fit(segments, labels, epochs=TRAIN_EPOCHS, verbose=False), repeat=2, number=1)
+        results[f'train/epoch {name}'] = seconds / TRAIN_EPOCHS
+    return results
+
+
+def bench_inference() -> Dict[str, float]:
+    import nn
+    from npnn import NumpyNN
+    from verdicts import SPACE
+
+    batch = SPACE.unrank_array(np.arange(INFERENCE_BATCH))
+    single = batch[:1]
+    results = {}
+    for name in LEVELS:
+        if not os.path.exists(os.path.join(DATA_DIR, f'{name}.torch')):
+            continue
+        try:
+            net = nn.load_net(name)
+        except RuntimeError as e:
+            logging.warning(f'Skipping {name}: {e}')
+            continue
+        numpy_net = NumpyNN.from_net(net)
+        results[f'inference/torch single {name}'] = measure(lambda: nn.predict_proba(net, single))
+        results[f'inference/torch batch {name}'] = measure(lambda: nn.predict_proba(net, batch)) / INFERENCE_BATCH
+        results[f'inference/numpy single {name}'] = measure(lambda: numpy_net.predict_proba(single))
+        results[f'inference/numpy batch {name}'] = measure(lambda: numpy_net.predict_proba(batch)) / INFERENCE_BATCH
+    return results
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'screen': bench_screen,
+    'sampling': bench_sampling,
+    'loading': bench_loading,
+    'train': bench_train,
+    'inference': bench_inference,
+}
+
+
+def record(frames: int = 4):
+    # record from whatever backend is installed, the live screen unless --sim picked the simulator
+    screen = InputScreen()
+    screen.init()
+    screen.open_level()
+    images = [get_backend().grab()]
+    rng = np.random.default_rng(0)
+    for _ in range(frames - 1):
+        length = int(rng.integers(1, MAX_CATERPILLAR_SIZE + 1))
+        combo = [int(v) for v in rng.integers(1, 5, length)] + [0] * (MAX_CATERPILLAR_SIZE - length)
+        screen.check_caterpillar(Caterpillar.from_json(combo))
+        images.append(get_backend().grab())
+    RecordedBackend(images, screen.settings()).save(FRAMES_DIR)
+    logging.info(f'Recorded {len(images)} frames to {FRAMES_DIR}')
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in [('s', 1), ('ms', 1e-3), ('us', 1e-6)]:
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def _format_change(seconds: float, before: Optional[float]) -> str:
+    if before is None:
+        return ''
+    change = seconds / before - 1
+    if abs(change) < NOISE:
+        return f'{change:+.0%}'
+    return f'{change:+.0%} {"slower" if change > 0 else "faster"}'
+
+
+def _load(path: str) -> Dict[str, float]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)['results']
+
+
+def compare(results: Dict[str, float], previous: Dict[str, float], baseline: Dict[str, float]):
+    width = max(len(k) for k in results)
+    print(f'{"benchmark":<{width}} {"time":>10} {"previous":>10} {"change":>14} {"baseline":>10} {"change":>14}')
+    for key, seconds in results.items():
+        before, base = previous.get(key), baseline.get(key)
+        print(f'{key:<{width}} {_format_time(seconds):>10} '
+              f'{_format_time(before) if before else "":>10} {_format_change(seconds, before):>14} '
+              f'{_format_time(base) if base else "":>10} {_format_change(seconds, base):>14}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('groups', nargs='*', help=f'any of {", ".join(GROUPS)}, defaults to all of them')
+    parser.add_argument('--record', action='store_true', help='record new screenshots instead of benchmarking')
+    parser.add_argument('--sim', help='record from the simulator with this rule instead of the live screen')
+    parser.add_argument('--save-baseline', action='store_true', help='make this run the new baseline')
+    args = parser.parse_args()
+    unknown = set(args.groups) - set(GROUPS)
+    if unknown:
+        parser.error(f'unknown benchmark groups {sorted(unknown)}')
+
+    if args.record:
+        if args.sim:
+            import sim
+            sim.install(sim.rule_by_name(args.sim), seed=0)
+        record()
+        return
+
+    results = {}
+    for group in args.groups or GROUPS:
+        logging.info(f'Running the {group} benchmarks')
+        results.update(BENCHMARKS[group]())
+
+    compare(results, _load(RESULTS_FILE), _load(BASELINE_FILE))
+    run = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'machine': f'{platform.node()} {platform.machine()} python {platform.python_version()}',
+        # keep benchmarks this run skipped, so the next comparison still has them
+        'results': {**_load(RESULTS_FILE), **results},
+    }
+    paths = [RESULTS_FILE] + ([BASELINE_FILE] if args.save_baseline else [])
+    for path in paths:
+        with open(path, 'w') as f:
+            json.dump(run, f, indent=2)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
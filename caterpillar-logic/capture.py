@@ -0,0 +1,93 @@
+import math
+import threading
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+import metrics
+from backend import BBox, get_backend
+
+CAPTURE_RATE = 240.0
+RING_SIZE = 8
+
+
+class Frame(NamedTuple):
+    index: int
+    timestamp: float
+    # a view into the ring, it is overwritten RING_SIZE frames later so copy anything kept longer
+    pixels: np.ndarray
+
+
+class CaptureService:
+    def __init__(self, bbox: BBox, rate: float = CAPTURE_RATE, size: int = RING_SIZE):
+        self.bbox = bbox
+        self.period = 1 / rate if rate else 0.0
+        self.ring = np.zeros((size, bbox[3] - bbox[1], bbox[2] - bbox[0], 3), dtype=np.uint8)
+        self.timestamps = np.full(size, -math.inf)
+        self.count = 0
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.error: Optional[BaseException] = None
+
+    def start(self) -> 'CaptureService':
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='capture', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self) -> 'CaptureService':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _run(self):
+        backend = get_backend()
+        try:
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                image = backend.grab(bbox=self.bbox)
+                # the slot being written is the oldest one, readers only ever hand out the newest
+                slot = self.count % len(self.ring)
+                self.ring[slot] = np.asarray(image.convert('RGB'))
+                with self.condition:
+                    self.timestamps[slot] = start
+                    self.count += 1
+                    self.condition.notify_all()
+                metrics.observe('capture.grab', time.perf_counter() - start)
+                if self.period:
+                    self.stopped.wait(start + self.period - time.perf_counter())
+        except BaseException as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            raise
+
+    def _newest(self) -> Frame:
+        index = self.count - 1
+        slot = index % len(self.ring)
+        return Frame(index, float(self.timestamps[slot]), self.ring[slot])
+
+    def latest(self) -> Optional[Frame]:
+        with self.condition:
+            return self._newest() if self.count else None
+
+    def wait_newer(self, timestamp: float = -math.inf, timeout: Optional[float] = None) -> Optional[Frame]:
+        # a frame is newer when its grab started after the timestamp, so it shows anything done before then
+        def ready() -> bool:
+            return self.error is not None or (self.count > 0 and self._newest().timestamp > timestamp)
+
+        with self.condition:
+            if not self.condition.wait_for(ready, timeout):
+                return None
+            if self.error is not None:
+                raise RuntimeError('The capture thread stopped') from self.error
+            return self._newest()
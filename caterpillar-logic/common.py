@@ -1,13 +1,19 @@
+import hashlib
 import json
 import logging
 import math
 import os
+import random
 import time
+from contextlib import contextmanager
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-from PIL import ImageGrab
-from pynput import mouse
+import numpy as np
+
+import metrics
+from backend import BBox, get_backend
+from capture import CAPTURE_RATE, CaptureService, Frame
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 DATA_DIR = os.path.join(THIS_DIR, 'data')
@@ -18,7 +24,14 @@ MAX_CATERPILLAR_SIZE = 7
 DEFAULT_CATERPILLAR_SIZE = 6
 NUM_DEFAULT_CATERPILLARS = 7
 CLICK_DELAY = 0.05
-controller = mouse.Controller()
+CHECK_TIMEOUT = 2.0
+NAV_TIMEOUT = 5.0
+# how long the caterpillars must stay unchanged before a level counts as drawn, a few frames at 60 fps
+NAV_SETTLE = 0.05
+CALIBRATION_DELAYS = (0.0, 0.005, 0.01, 0.02, 0.03, CLICK_DELAY)
+CALIBRATION_TRIALS = 3
+# largest per channel difference from the calibrated reference pixels that still counts as the same screen
+PROFILE_TOLERANCE = 24
 
 
 class Color(Enum):
@@ -35,12 +48,61 @@ class Color(Enum):
         return str(self)
 
 
+COLORS = tuple(Color)
+COLOR_BASE = len(COLORS)
+# segment i is packed as the i-th base-5 digit, so the first segment is the least significant
+SEGMENT_WEIGHTS = COLOR_BASE ** np.arange(MAX_CATERPILLAR_SIZE, dtype=np.int64)
+NUM_CODES = COLOR_BASE ** MAX_CATERPILLAR_SIZE
+
+
+def pack_codes(segments: np.ndarray) -> np.ndarray:
+    segments = np.asarray(segments, dtype=np.int64)
+    # an out of range segment would carry into the next one and pack as a different caterpillar
+    assert segments.size == 0 or (segments.min() >= 0 and segments.max() < COLOR_BASE), segments
+    return segments @ SEGMENT_WEIGHTS
+
+
+def unpack_codes(codes: np.ndarray) -> np.ndarray:
+    return (np.asarray(codes, dtype=np.int64)[..., np.newaxis] // SEGMENT_WEIGHTS % COLOR_BASE).astype(np.uint8)
+
+
+_interned: Dict[int, 'Caterpillar'] = {}
+
+
 class Caterpillar:
-    def __init__(self, combo: Tuple[Color]):
+    __slots__ = ('code',)
+
+    def __new__(cls, combo: Tuple[Color]):
         assert isinstance(combo, tuple)
         assert len(combo) == MAX_CATERPILLAR_SIZE, combo
 
-        self.combo = combo
+        code = 0
+        for color in reversed(combo):
+            code = code * COLOR_BASE + color.value
+        return cls.from_code(code)
+
+    @classmethod
+    def from_code(cls, code: int) -> 'Caterpillar':
+        caterpillar = _interned.get(code)
+        if caterpillar is None:
+            assert 0 <= code < NUM_CODES, code
+            caterpillar = object.__new__(cls)
+            caterpillar.code = code
+            _interned[code] = caterpillar
+        return caterpillar
+
+    @classmethod
+    def from_codes(cls, codes: Sequence[int]) -> 'Caterpillar':
+        assert len(codes) == MAX_CATERPILLAR_SIZE, codes
+        return cls.from_code(int(pack_codes(codes)))
+
+    @classmethod
+    def from_json(cls, values: List[int]) -> 'Caterpillar':
+        return cls.from_codes(values)
+
+    @property
+    def combo(self) -> Tuple[Color]:
+        return tuple(COLORS[v] for v in self.json())
 
     def __str__(self):
         return f'Catepillar({",".join(str(c).rjust(5) for c in self.combo)})'
@@ -48,19 +110,54 @@ class Caterpillar:
     def __repr__(self):
         return self.__str__()
 
+    def __reduce__(self):
+        return Caterpillar.from_code, (self.code,)
+
     def __hash__(self):
-        return self.combo.__hash__()
+        return self.code
 
     def __eq__(self, other):
         if not isinstance(other, Caterpillar):
             raise TypeError()
-        return all(a == b for a, b in zip(other.combo, self.combo))
+        return self.code == other.code
 
     def __len__(self):
-        return sum(c.value > 0 for c in self.combo)
+        return sum(v > 0 for v in self.json())
 
     def json(self) -> List[int]:
-        return [c.value for c in self.combo]
+        values = []
+        code = self.code
+        for _ in range(MAX_CATERPILLAR_SIZE):
+            code, value = divmod(code, COLOR_BASE)
+            values.append(value)
+        return values
+
+
+def caterpillars_to_array(caterpillars: Iterable[Caterpillar]) -> np.ndarray:
+    return unpack_codes([c.code for c in caterpillars]).reshape(-1, MAX_CATERPILLAR_SIZE)
+
+
+def caterpillars_from_array(segments: np.ndarray) -> List[Caterpillar]:
+    return [Caterpillar.from_code(int(code)) for code in pack_codes(segments)]
+
+
+def load_results(path: str) -> Dict[Caterpillar, bool]:
+    with open(path, 'r') as f:
+        return {Caterpillar.from_json(values): bool(valid) for values, valid in json.load(f)}
+
+
+def dump_results(path: str, results: Dict[Caterpillar, bool]):
+    with open(path, 'w') as f:
+        json.dump([(c.json(), v) for c, v in results.items()], f)
+
+
+def model_fingerprint(name: str) -> str:
+    # files compiled from data/<name>.torch record this, so a retrained model makes them stale
+    path = os.path.join(DATA_DIR, f'{name}.torch')
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
 class ScreenLoc:
@@ -74,32 +171,27 @@ class ScreenLoc:
 
     @staticmethod
     def wait_for_click() -> 'ScreenLoc':
-        last_pressed: Tuple[int, int] = (-1, -1)
-
-        def on_click(x, y, button, pressed):
-            nonlocal last_pressed
-            if pressed:
-                last_pressed = (x, y)
-                logging.debug(f'{last_pressed}: {ImageGrab.grab().getpixel(last_pressed)}')
-                return False
-
-        with mouse.Listener(on_click=on_click) as listener:
-            listener.join()
+        last_pressed = get_backend().wait_for_click()
+        logging.debug(f'{last_pressed}: {get_backend().grab().getpixel(last_pressed)}')
         return ScreenLoc(last_pressed)
 
+    @metrics.timed('input.click')
     def click(self):
-        controller.position = self.xy
-        controller.press(mouse.Button.left)
-        time.sleep(CLICK_DELAY)
-        controller.release(mouse.Button.left)
-        time.sleep(CLICK_DELAY)
-
-    def get_raw_color(self):
-        raw = ImageGrab.grab().getpixel(self.xy)
+        get_backend().click(self.xy, hold=CLICK_DELAY)
+        with metrics.timer('input.click_sleep'):
+            time.sleep(CLICK_DELAY)
+
+    @metrics.timed('screen.get_raw_color')
+    def get_raw_color(self, snapshot: Optional['Snapshot'] = None):
+        if snapshot is not None:
+            return snapshot.get_raw_color(self)
+        raw = get_backend().grab().getpixel(self.xy)
         return raw
 
-    def get_color(self, color_lookup: Dict[Tuple[int, int, int], Color]) -> Color:
-        raw = self.get_raw_color()
+    @metrics.timed('screen.get_color')
+    def get_color(self, color_lookup: Dict[Tuple[int, int, int], Color],
+                  snapshot: Optional['Snapshot'] = None) -> Color:
+        raw = self.get_raw_color(snapshot)
 
         def dist(a: Tuple[int, int, int], b: Tuple[int, int, int]) -> float:
             return math.sqrt(sum((e1 - e2) ** 2 for e1, e2 in zip(a, b)))
@@ -107,6 +199,170 @@ class ScreenLoc:
         return min(color_lookup.items(), key=lambda x: dist(x[0], raw))[1]
 
 
+class ClickQueue:
+    def __init__(self, delay: float = CLICK_DELAY):
+        self.delay = delay
+        self.locs: List[ScreenLoc] = []
+
+    def add(self, loc: ScreenLoc, times: int = 1) -> 'ClickQueue':
+        self.locs.extend([loc] * times)
+        return self
+
+    @metrics.timed('input.send')
+    def send(self):
+        # press and release back to back, the game only needs the delay between clicks
+        backend = get_backend()
+        metrics.count('input.clicks', len(self.locs))
+        for loc in self.locs:
+            backend.click(loc.xy)
+            with metrics.timer('input.send_sleep'):
+                time.sleep(self.delay)
+        self.locs = []
+
+
+class ColorClassifier:
+    def __init__(self, color_lookup: Dict[Tuple[int, int, int], Color]):
+        # only compare rgb, some platforms grab rgba
+        self.palette = np.array([raw[:3] for raw in color_lookup.keys()], dtype=np.int32)
+        self.codes = np.array([c.value for c in color_lookup.values()], dtype=np.uint8)
+
+    @metrics.timed('screen.classify')
+    def classify(self, pixels: np.ndarray) -> np.ndarray:
+        pixels = np.asarray(pixels, dtype=np.int32)[..., :3]
+        # squared distance keeps the same nearest color (and tie order) as the euclidean distance
+        dists = ((pixels[..., np.newaxis, :] - self.palette) ** 2).sum(axis=-1)
+        return self.codes[dists.argmin(axis=-1)]
+
+
+def bounding_box(locs: List[ScreenLoc]) -> BBox:
+    xs = [loc.xy[0] for loc in locs]
+    ys = [loc.xy[1] for loc in locs]
+    # bbox is exclusive on the right/bottom
+    return min(xs), min(ys), max(xs) + 1, max(ys) + 1
+
+
+class Snapshot:
+    def __init__(self, locs: List[ScreenLoc]):
+        # grab only the bounding box of the points we will read
+        bbox = bounding_box(locs)
+        self.origin: Tuple[int, int] = bbox[:2]
+        with metrics.timer('screen.grab'):
+            self.pixels = np.asarray(get_backend().grab(bbox=bbox).convert('RGB'))
+
+    @classmethod
+    def from_pixels(cls, pixels: np.ndarray, origin: Tuple[int, int]) -> 'Snapshot':
+        snapshot = cls.__new__(cls)
+        snapshot.origin = origin
+        snapshot.pixels = pixels
+        return snapshot
+
+    @classmethod
+    @metrics.timed('screen.grab_full')
+    def full(cls) -> 'Snapshot':
+        return cls.from_pixels(np.asarray(get_backend().grab().convert('RGB')), (0, 0))
+
+    @classmethod
+    def from_frame(cls, frame: Frame, capture: CaptureService) -> 'Snapshot':
+        return cls.from_pixels(frame.pixels, capture.bbox[:2])
+
+    def copy(self) -> 'Snapshot':
+        # frames from a capture service are views into its ring, copy before keeping one around
+        return Snapshot.from_pixels(self.pixels.copy(), self.origin)
+
+    @property
+    def resolution(self) -> str:
+        return f'{self.pixels.shape[1]}x{self.pixels.shape[0]}'
+
+    def contains(self, locs: List[ScreenLoc]) -> bool:
+        height, width = self.pixels.shape[:2]
+        return all(0 <= loc.xy[0] - self.origin[0] < width and 0 <= loc.xy[1] - self.origin[1] < height
+                   for loc in locs)
+
+    def get_raw_color(self, loc: ScreenLoc) -> Tuple[int, int, int]:
+        return tuple(int(c) for c in self.pixels[loc.xy[1] - self.origin[1], loc.xy[0] - self.origin[0]])
+
+    def sample(self, locs: List[ScreenLoc]) -> np.ndarray:
+        xs = np.array([loc.xy[0] for loc in locs]) - self.origin[0]
+        ys = np.array([loc.xy[1] for loc in locs]) - self.origin[1]
+        return self.pixels[ys, xs]
+
+
+def fingerprint(snapshot: Snapshot, locs: List[ScreenLoc]) -> List[List[int]]:
+    return snapshot.sample(locs)[:, :3].tolist()
+
+
+def fingerprint_matches(snapshot: Snapshot, locs: List[ScreenLoc], expected: Optional[List[List[int]]]) -> bool:
+    if expected is None or len(expected) != len(locs) or not snapshot.contains(locs):
+        return False
+    diff = np.abs(snapshot.sample(locs)[:, :3].astype(np.int32) - np.array(expected, dtype=np.int32))
+    return int(diff.max()) <= PROFILE_TOLERANCE
+
+
+def left_filled(codes: np.ndarray) -> bool:
+    filled = np.asarray(codes) > 0
+    return bool((filled[..., 1:] <= filled[..., :-1]).all())
+
+
+def load_profile(path: str, resolution: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if 'profiles' not in data:
+        # a file from before profiles, it has no fingerprint so it gets confirmed once and then saved as one
+        return data
+    return data['profiles'].get(resolution)
+
+
+def save_profile(path: str, resolution: str, settings: Dict):
+    profiles = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            profiles = json.load(f).get('profiles', {})
+    profiles[resolution] = settings
+    with open(path, 'w') as f:
+        json.dump({'profiles': profiles}, f)
+
+
+class RegionWatcher:
+    def __init__(self, locs: List[ScreenLoc], poll_delay: float = 0.0, capture: Optional[CaptureService] = None):
+        self.locs = locs
+        self.poll_delay = poll_delay
+        self.service = capture
+        self.last_hash: Optional[int] = None
+        self.last_timestamp = -math.inf
+
+    def _snapshot(self, timeout: Optional[float] = None) -> Optional[Snapshot]:
+        if self.service is None:
+            snapshot = Snapshot(self.locs)
+        else:
+            # take the next frame from the capture thread instead of grabbing here
+            frame = self.service.wait_newer(self.last_timestamp, timeout)
+            if frame is None:
+                return None
+            self.last_timestamp = frame.timestamp
+            snapshot = Snapshot.from_frame(frame, self.service)
+        metrics.count('screen.watch_polls')
+        self.last_hash = hash(snapshot.sample(self.locs).tobytes())
+        return snapshot
+
+    def capture(self) -> Snapshot:
+        return self._snapshot()
+
+    def changes(self, timeout: float) -> Iterator[Snapshot]:
+        # yields each capture that differs from the previous one until the timeout expires
+        end = time.perf_counter() + timeout
+        while time.perf_counter() < end:
+            previous = self.last_hash
+            snapshot = self._snapshot(end - time.perf_counter())
+            if snapshot is None:
+                return
+            if self.last_hash != previous:
+                yield snapshot
+            elif self.poll_delay:
+                time.sleep(self.poll_delay)
+
+
 class InputScreen:
     def __init__(self):
         self.level: ScreenLoc = None
@@ -119,37 +375,128 @@ class InputScreen:
         self.delete: ScreenLoc = None
         self.red: ScreenLoc = None
         self.ok: ScreenLoc = None
+        self.click_delay: float = CLICK_DELAY
 
         self.color_lookup: Dict[Tuple[int, int, int], Color] = {}
+        self.classifier: ColorClassifier = None
         self.valid_loc: List[ScreenLoc] = []
         self.invalid_loc: List[ScreenLoc] = []
         self.cat_offsets: List[ScreenLoc] = []
-
-    def open_level(self):
-        while self.valid_caterpillar() == self.invalid_caterpillar():
-            self.level.click()
-        self.clear()
-
+        self.last_verdict_latency: Optional[float] = None
+        self.resolution: Optional[str] = None
+        self.capture: Optional[CaptureService] = None
+
+    def _level_open(self, snapshot: Optional[Snapshot] = None) -> bool:
+        if snapshot is None:
+            snapshot = self.snapshot()
+        return self.valid_caterpillar(snapshot=snapshot) != self.invalid_caterpillar(snapshot=snapshot)
+
+    @metrics.timed('nav.wait_for_level')
+    def wait_for_level(self, is_open: bool, timeout: float = NAV_TIMEOUT,
+                       settle: float = NAV_SETTLE) -> Optional[Snapshot]:
+        # the level has loaded (or closed) once the captures stop changing for the settle window,
+        # back to back captures from the capture thread can still agree halfway through an animation
+        watcher = RegionWatcher(self._caterpillar_locs(), capture=self.capture)
+        end = time.perf_counter() + timeout
+        previous = None
+        stable_since = time.perf_counter()
+        while time.perf_counter() < end:
+            snapshot = watcher.capture()
+            now = time.perf_counter()
+            if watcher.last_hash != previous:
+                previous = watcher.last_hash
+                stable_since = now
+            elif now - stable_since >= settle and self._level_open(snapshot) == is_open:
+                return snapshot
+        return None
+
+    @metrics.timed('nav.open_level')
+    def open_level(self, clear: bool = True) -> Snapshot:
+        snapshot = self.snapshot()
+        while not self._level_open(snapshot):
+            # the wait below already polls for the level, only the calibrated delay is needed
+            ClickQueue(self.click_delay).add(self.level).send()
+            snapshot = self.wait_for_level(True) or self.snapshot()
+        if clear:
+            self.clear()
+        return snapshot
+
+    @metrics.timed('nav.back_out')
     def back_out(self):
-        while self.valid_caterpillar() != self.invalid_caterpillar():
-            self.back.click()
-            time.sleep(1)
-
-    def valid_caterpillar(self, idx: int = 0) -> Caterpillar:
-        offset = self.cat_offsets[idx]
-        colors = [(loc + offset).get_color(self.color_lookup) for loc in self.valid_loc]
-        caterpillar = Caterpillar(tuple(colors))
-        return caterpillar
-
-    def invalid_caterpillar(self, idx: int = 0) -> Caterpillar:
+        while self._level_open():
+            ClickQueue(self.click_delay).add(self.back).send()
+            self.wait_for_level(False)
+
+    def _caterpillar_locs(self) -> List[ScreenLoc]:
+        return [loc + offset for offset in self.cat_offsets for loc in self.valid_loc + self.invalid_loc]
+
+    def snapshot(self) -> Snapshot:
+        if self.capture is not None:
+            return Snapshot.from_frame(self.capture.latest() or self.capture.wait_newer(), self.capture)
+        return Snapshot(self._caterpillar_locs())
+
+    @contextmanager
+    def capturing(self, rate: float = CAPTURE_RATE) -> Iterator[CaptureService]:
+        # every read of the caterpillars comes from a background capture of their region while this is open
+        self.capture = CaptureService(bounding_box(self._caterpillar_locs()), rate).start()
+        try:
+            yield self.capture
+        finally:
+            self.capture.stop()
+            self.capture = None
+
+    def _read_caterpillar(self, locs: List[ScreenLoc], idx: int, snapshot: Optional[Snapshot]) -> Caterpillar:
+        if snapshot is None:
+            snapshot = self.snapshot()
         offset = self.cat_offsets[idx]
-        colors = [(loc + offset).get_color(self.color_lookup) for loc in self.invalid_loc]
-        caterpillar = Caterpillar(tuple(colors))
-        return caterpillar
-
-    def clear(self):
-        for _ in range(MAX_CATERPILLAR_SIZE):
-            self.delete.click()
+        codes = self.classifier.classify(snapshot.sample([loc + offset for loc in locs]))
+        return Caterpillar.from_codes(codes)
+
+    def valid_caterpillar(self, idx: int = 0, snapshot: Optional[Snapshot] = None) -> Caterpillar:
+        return self._read_caterpillar(self.valid_loc, idx, snapshot)
+
+    def invalid_caterpillar(self, idx: int = 0, snapshot: Optional[Snapshot] = None) -> Caterpillar:
+        return self._read_caterpillar(self.invalid_loc, idx, snapshot)
+
+    @metrics.timed('screen.read_caterpillars')
+    def read_caterpillars(self, snapshot: Optional[Snapshot] = None) -> Tuple[List[Caterpillar], List[Caterpillar]]:
+        if snapshot is None:
+            snapshot = self.snapshot()
+        # classify every segment of every caterpillar in a single call
+        locs = self._caterpillar_locs()
+        codes = self.classifier.classify(snapshot.sample(locs)).reshape(len(self.cat_offsets), 2, -1)
+        valid = caterpillars_from_array(codes[:, 0])
+        invalid = caterpillars_from_array(codes[:, 1])
+        return valid, invalid
+
+    def clear(self, delay: Optional[float] = None):
+        ClickQueue(self.click_delay if delay is None else delay).add(self.delete, MAX_CATERPILLAR_SIZE).send()
+
+    def _entry(self, caterpillar: Caterpillar, delay: Optional[float] = None) -> ClickQueue:
+        buttons = {Color.Red: self.red, Color.Green: self.green, Color.Blue: self.blue, Color.Grey: self.grey}
+        clicks = ClickQueue(self.click_delay if delay is None else delay)
+        for color in caterpillar.combo:
+            if color in buttons:
+                clicks.add(buttons[color])
+        return clicks.add(self.ok)
+
+    def calibrate_click_delay(self, delays: Tuple[float, ...] = CALIBRATION_DELAYS,
+                              trials: int = CALIBRATION_TRIALS) -> float:
+        colors = [Color.Red, Color.Green, Color.Blue, Color.Grey]
+        for delay in sorted(delays):
+            try:
+                for _ in range(trials):
+                    combo = tuple(random.choice(colors) for _ in range(MAX_CATERPILLAR_SIZE))
+                    self.check_caterpillar(Caterpillar(combo), delay=delay)
+            except AssertionError:
+                logging.info(f'Clicks are dropped with a {delay * 1000:.0f} ms delay.')
+                # get rid of any partial entry with the known good delay
+                self.clear(CLICK_DELAY)
+                continue
+            self.click_delay = delay
+            break
+        logging.info(f'Using a click delay of {self.click_delay * 1000:.0f} ms.')
+        return self.click_delay
 
     def _set_meta_buttons(self):
         print('Click on the back button')
@@ -157,14 +504,17 @@ class InputScreen:
         print('Click on the level')
         self.level = ScreenLoc.wait_for_click()
 
-    def _set_color_lookup(self):
+    def _set_color_lookup(self, snapshot: Optional[Snapshot] = None):
+        if snapshot is None:
+            snapshot = Snapshot([self.red, self.green, self.blue, self.grey])
         self.color_lookup = {
             (0, 0, 0): Color.Null,
-            self.red.get_raw_color(): Color.Red,
-            self.green.get_raw_color(): Color.Green,
-            self.blue.get_raw_color(): Color.Blue,
-            self.grey.get_raw_color(): Color.Grey,
+            self.red.get_raw_color(snapshot): Color.Red,
+            self.green.get_raw_color(snapshot): Color.Green,
+            self.blue.get_raw_color(snapshot): Color.Blue,
+            self.grey.get_raw_color(snapshot): Color.Grey,
         }
+        self.classifier = ColorClassifier(self.color_lookup)
         logging.debug(self.color_lookup)
 
     def _set_input_loc(self):
@@ -203,10 +553,8 @@ class InputScreen:
             self.cat_offsets.append(ScreenLoc((0, screen_loc.xy[1] - first_y)))
 
     def _confirm_valid_loc(self):
-        caterpillars = []
         logging.info('Please wait while reading the caterpillars from the screen...')
-        for idx in range(NUM_DEFAULT_CATERPILLARS):
-            caterpillars.append(self.valid_caterpillar(idx))
+        caterpillars, _ = self.read_caterpillars()
         fmt_str = 'Confirm the colors of the valid caterpillars:\n{}\n[y/n]'
         if input(fmt_str.format("\n".join([str(c) for c in caterpillars]))).lower() != 'y':
             self._set_caterpillar_offsets()
@@ -220,10 +568,8 @@ class InputScreen:
         self._confirm_valid_loc()
 
     def _confirm_invalid_loc(self):
-        caterpillars = []
         logging.info('Please wait while reading the caterpillars from the screen...')
-        for idx in range(NUM_DEFAULT_CATERPILLARS):
-            caterpillars.append(self.invalid_caterpillar(idx))
+        _, caterpillars = self.read_caterpillars()
         fmt_str = 'Confirm the colors of the invalid caterpillars:\n{}\n[y/n]'
         if input(fmt_str.format("\n".join([str(c) for c in caterpillars]))).lower() != 'y':
             self._set_invalid_loc()
@@ -235,95 +581,161 @@ class InputScreen:
             self.invalid_loc.append(ScreenLoc.wait_for_click())
         self._confirm_invalid_loc()
 
-    def init(self):
-        if not self.load():
+    def init(self, calibrate: bool = False):
+        settings = get_backend().settings('input')
+        if settings is not None:
+            # the backend knows its own layout, nothing to confirm or save
+            self.load_settings(settings, confirm=False)
+        elif not self.load() and not self.detect():
             self._set_input_loc()
             self._set_caterpillar_offsets()
             self._set_valid_loc()
             self._set_invalid_loc()
+        if calibrate:
+            self.calibrate_click_delay()
+        if self.back is None or self.level is None:
+            self._set_meta_buttons()
+        if settings is None:
             self.dump()
-        self._set_meta_buttons()
+
+    def _reference_locs(self) -> List[ScreenLoc]:
+        # the input buttons look the same on every level, unlike the caterpillars
+        return [self.red, self.green, self.blue, self.grey, self.delete, self.ok]
+
+    def _verified(self, snapshot: Snapshot, expected: Optional[List[List[int]]]) -> bool:
+        if not fingerprint_matches(snapshot, self._reference_locs(), expected):
+            return False
+        locs = self._caterpillar_locs()
+        if not snapshot.contains(locs):
+            return False
+        return left_filled(self.classifier.classify(snapshot.sample(locs)).reshape(-1, MAX_CATERPILLAR_SIZE))
 
     def load(self) -> bool:
-        if not os.path.exists(INPUT_SCREEN_FILE):
+        # one full frame gives the resolution, the fingerprint and the color lookup
+        snapshot = Snapshot.full()
+        self.resolution = snapshot.resolution
+        settings = load_profile(INPUT_SCREEN_FILE, self.resolution)
+        if settings is None or not self.load_settings(settings, confirm=False, snapshot=snapshot):
             return False
+        if self._verified(snapshot, settings.get('fingerprint')):
+            logging.info(f'Verified the {self.resolution} calibration.')
+        else:
+            logging.warning(f'The screen does not match the {self.resolution} calibration, please confirm it.')
+            self._confirm_valid_loc()
+            self._confirm_invalid_loc()
+        return True
 
-        with open(INPUT_SCREEN_FILE, 'r') as f:
-            settings = json.load(f)
-            if 'red' not in settings:
-                return False
-            self.red = ScreenLoc(tuple(settings['red']))
-            if 'green' not in settings:
-                return False
-            self.green = ScreenLoc(tuple(settings['green']))
-            if 'blue' not in settings:
-                return False
-            self.blue = ScreenLoc(tuple(settings['blue']))
-            if 'grey' not in settings:
-                return False
-            self.grey = ScreenLoc(tuple(settings['grey']))
-            if 'backspace' not in settings:
-                return False
-            self.delete = ScreenLoc(tuple(settings['backspace']))
-            if 'ok' not in settings:
-                return False
-            self.ok = ScreenLoc(tuple(settings['ok']))
-            self._set_color_lookup()
-            if 'offsets' not in settings:
-                return False
-            self.cat_offsets = [ScreenLoc(tuple(v)) for v in settings['offsets']]
-            if 'valid' not in settings:
-                return False
-            self.valid_loc = [ScreenLoc(tuple(v)) for v in settings['valid']]
-            if len(self.valid_loc) != MAX_CATERPILLAR_SIZE:
-                return False
+    def detect(self) -> bool:
+        from layout import detect_input_layout
+
+        snapshot = Snapshot.full()
+        settings = detect_input_layout(snapshot.pixels)
+        if settings is None or not self.load_settings(settings, confirm=False, snapshot=snapshot):
+            return False
+        logging.info('Detected the input screen layout.')
+        # answering y/n is quick, a wrong detection falls back to clicking
+        self._confirm_valid_loc()
+        self._confirm_invalid_loc()
+        return True
+
+    def load_settings(self, settings: Dict, confirm: bool = True, snapshot: Optional[Snapshot] = None) -> bool:
+        if 'red' not in settings:
+            return False
+        self.red = ScreenLoc(tuple(settings['red']))
+        if 'green' not in settings:
+            return False
+        self.green = ScreenLoc(tuple(settings['green']))
+        if 'blue' not in settings:
+            return False
+        self.blue = ScreenLoc(tuple(settings['blue']))
+        if 'grey' not in settings:
+            return False
+        self.grey = ScreenLoc(tuple(settings['grey']))
+        if 'backspace' not in settings:
+            return False
+        self.delete = ScreenLoc(tuple(settings['backspace']))
+        if 'ok' not in settings:
+            return False
+        self.ok = ScreenLoc(tuple(settings['ok']))
+        self._set_color_lookup(snapshot)
+        self.click_delay = settings.get('click_delay', CLICK_DELAY)
+        if 'offsets' not in settings:
+            return False
+        self.cat_offsets = [ScreenLoc(tuple(v)) for v in settings['offsets']]
+        if 'valid' not in settings:
+            return False
+        self.valid_loc = [ScreenLoc(tuple(v)) for v in settings['valid']]
+        if len(self.valid_loc) != MAX_CATERPILLAR_SIZE:
+            return False
+        if confirm:
             self._confirm_valid_loc()
-            if 'invalid' not in settings:
-                return False
-            self.invalid_loc = [ScreenLoc(tuple(v)) for v in settings['invalid']]
-            if len(self.invalid_loc) != MAX_CATERPILLAR_SIZE:
-                return False
+        if 'invalid' not in settings:
+            return False
+        self.invalid_loc = [ScreenLoc(tuple(v)) for v in settings['invalid']]
+        if len(self.invalid_loc) != MAX_CATERPILLAR_SIZE:
+            return False
+        if confirm:
             self._confirm_invalid_loc()
-        self.dump()
+        if 'back' in settings and 'level' in settings:
+            self.back = ScreenLoc(tuple(settings['back']))
+            self.level = ScreenLoc(tuple(settings['level']))
         return True
 
+    def settings(self) -> Dict:
+        settings = {
+            'red': self.red.xy,
+            'green': self.green.xy,
+            'blue': self.blue.xy,
+            'grey': self.grey.xy,
+            'backspace': self.delete.xy,
+            'ok': self.ok.xy,
+            'click_delay': self.click_delay,
+            'offsets': [o.xy for o in self.cat_offsets],
+            'valid': [v.xy for v in self.valid_loc],
+            'invalid': [i.xy for i in self.invalid_loc]
+        }
+        if self.back is not None and self.level is not None:
+            settings.update({'back': self.back.xy, 'level': self.level.xy})
+        return settings
+
     def dump(self):
-        with open(INPUT_SCREEN_FILE, 'w') as f:
-            json.dump({
-                'red': self.red.xy,
-                'green': self.green.xy,
-                'blue': self.blue.xy,
-                'grey': self.grey.xy,
-                'backspace': self.delete.xy,
-                'ok': self.ok.xy,
-                'offsets': [o.xy for o in self.cat_offsets],
-                'valid': [v.xy for v in self.valid_loc],
-                'invalid': [i.xy for i in self.invalid_loc]
-            }, f)
-
-    def check_caterpillar(self, caterpillar: Caterpillar) -> bool:
+        snapshot = Snapshot.full()
+        self.resolution = snapshot.resolution
+        settings = self.settings()
+        settings['fingerprint'] = fingerprint(snapshot, self._reference_locs())
+        save_profile(INPUT_SCREEN_FILE, self.resolution, settings)
+
+    def _verdict(self, caterpillar: Caterpillar, snapshot: Snapshot) -> Optional[bool]:
+        if caterpillar == self.valid_caterpillar(snapshot=snapshot):
+            return True
+        elif caterpillar == self.invalid_caterpillar(snapshot=snapshot):
+            return False
+        return None
+
+    @metrics.timed('curate.check_caterpillar')
+    def check_caterpillar(self, caterpillar: Caterpillar, timeout: float = CHECK_TIMEOUT,
+                          delay: Optional[float] = None) -> bool:
         logging.info(f'Checking {caterpillar}')
-        for color in caterpillar.combo:
-            if color == Color.Red:
-                self.red.click()
-            if color == Color.Green:
-                self.green.click()
-            if color == Color.Blue:
-                self.blue.click()
-            if color == Color.Grey:
-                self.grey.click()
-        self.ok.click()
-        # add a delay for the caterpillar to be validated lol
-        iteration = 100
-        for _ in range(iteration):
-            if caterpillar == self.valid_caterpillar():
-                logging.info(f'{caterpillar}: Valid')
-                return True
-            elif caterpillar == self.invalid_caterpillar():
-                logging.info(f'{caterpillar}: Invalid')
-                return False
-            time.sleep(0.01)
-        raise AssertionError(f'Could not find {caterpillar}')
+        # only watch the newest valid/invalid caterpillar, that is where the verdict shows up
+        watcher = RegionWatcher(self.valid_loc + self.invalid_loc, capture=self.capture)
+        watcher.capture()
+        # send the colors and ok as one batch
+        self._entry(caterpillar, delay).send()
+        start = time.perf_counter()
+        verdict = None
+        for snapshot in watcher.changes(timeout):
+            verdict = self._verdict(caterpillar, snapshot)
+            if verdict is not None:
+                break
+        if verdict is None:
+            # the region does not change when the same caterpillar was already on top
+            verdict = self._verdict(caterpillar, watcher.capture())
+        if verdict is None:
+            raise AssertionError(f'Could not find {caterpillar}')
+        self.last_verdict_latency = time.perf_counter() - start
+        metrics.observe('curate.verdict_wait', self.last_verdict_latency)
+        logging.info(f'{caterpillar}: {"Valid" if verdict else "Invalid"} ({self.last_verdict_latency * 1000:.0f} ms)')
+        return verdict
 
 
 class TestScreen:
@@ -332,42 +744,96 @@ class TestScreen:
             input_screen = InputScreen()
         input_screen.init()
         self.color_lookup = input_screen.color_lookup
+        self.classifier = input_screen.classifier
 
         self.valid: ScreenLoc = None
         self.invalid: ScreenLoc = None
         self.caterpillar: List[ScreenLoc] = []
+        self.resolution: Optional[str] = None
 
-    def test_caterpillar(self) -> Caterpillar:
-        colors = [loc.get_color(self.color_lookup) for loc in self.caterpillar]
-        caterpillar = Caterpillar(tuple(colors))
+    def test_caterpillar(self, snapshot: Optional[Snapshot] = None) -> Caterpillar:
+        if snapshot is None:
+            snapshot = Snapshot(self.caterpillar)
+        codes = self.classifier.classify(snapshot.sample(self.caterpillar))
+        caterpillar = Caterpillar.from_codes(codes)
         return caterpillar
 
     def _confirm_test_loc(self):
         logging.info('Please wait while reading the caterpillars from the screen...')
         caterpillar = self.test_caterpillar()
         if input(f'Confirm the colors of the test caterpillar: {caterpillar}[y/n]').lower() != 'y':
-            self._set_test_screen()
+            self._set_test_screen(detect=False)
+
+    def _detect_test_caterpillar(self) -> bool:
+        from layout import detect_test_caterpillar
+
+        # the caterpillar shows up a moment after the ready button
+        end = time.perf_counter() + CHECK_TIMEOUT
+        while time.perf_counter() < end:
+            locs = detect_test_caterpillar(Snapshot.full().pixels, self.color_lookup)
+            if locs is not None:
+                self.caterpillar = [ScreenLoc(xy) for xy in locs]
+                logging.info('Detected the test caterpillar.')
+                return True
+        return False
 
-    def _set_test_screen(self):
+    def _set_test_screen(self, detect: bool = True):
         print('Click on the center of the ready for test button')
         ready = ScreenLoc.wait_for_click()
-        print('Click one each segment of the test caterpillar, left-to-right, one at a time (7 total clicks).')
-        self.caterpillar = []
-        for _ in range(MAX_CATERPILLAR_SIZE):
-            self.caterpillar.append(ScreenLoc.wait_for_click())
+        if not detect or not self._detect_test_caterpillar():
+            print('Click one each segment of the test caterpillar, left-to-right, one at a time (7 total clicks).')
+            self.caterpillar = []
+            for _ in range(MAX_CATERPILLAR_SIZE):
+                self.caterpillar.append(ScreenLoc.wait_for_click())
         self._confirm_test_loc()
 
         self.valid = ScreenLoc((self.caterpillar[0].xy[0], ready.xy[1]))
         self.invalid = ScreenLoc((self.caterpillar[-1].xy[0], ready.xy[1]))
 
     def init(self):
-        self._set_test_screen()
+        settings = get_backend().settings('test')
+        if settings is not None:
+            self.load_settings(settings)
+            return
+        if not self.load():
+            self._set_test_screen()
         self.dump()
 
+    def load(self) -> bool:
+        snapshot = Snapshot.full()
+        self.resolution = snapshot.resolution
+        settings = load_profile(TEST_SCREEN_FILE, self.resolution)
+        if settings is None or not self.load_settings(settings):
+            return False
+        if (fingerprint_matches(snapshot, [self.valid, self.invalid], settings.get('fingerprint'))
+                and snapshot.contains(self.caterpillar)
+                and left_filled(self.test_caterpillar(snapshot).json())):
+            logging.info(f'Verified the {self.resolution} test screen calibration.')
+        else:
+            logging.warning(f'The screen does not match the {self.resolution} test calibration, please confirm it.')
+            self._confirm_test_loc()
+        return True
+
+    def load_settings(self, settings: Dict) -> bool:
+        if 'caterpillar' not in settings or len(settings['caterpillar']) != MAX_CATERPILLAR_SIZE:
+            return False
+        self.caterpillar = [ScreenLoc(tuple(v)) for v in settings['caterpillar']]
+        if 'valid' not in settings or 'invalid' not in settings:
+            return False
+        self.valid = ScreenLoc(tuple(settings['valid']))
+        self.invalid = ScreenLoc(tuple(settings['invalid']))
+        return True
+
+    def settings(self) -> Dict:
+        return {
+            'caterpillar': [v.xy for v in self.caterpillar],
+            'valid': self.valid.xy,
+            'invalid': self.invalid.xy
+        }
+
     def dump(self):
-        with open(TEST_SCREEN_FILE, 'w') as f:
-            json.dump({
-                'caterpillar': [v.xy for v in self.caterpillar],
-                'valid': self.valid.xy,
-                'invalid': self.invalid.xy
-            }, f)
+        snapshot = Snapshot.full()
+        self.resolution = snapshot.resolution
+        settings = self.settings()
+        settings['fingerprint'] = fingerprint(snapshot, [self.valid, self.invalid])
+        save_profile(TEST_SCREEN_FILE, self.resolution, settings)
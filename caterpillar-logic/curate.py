@@ -1,101 +1,201 @@
 import argparse
-import json
 import logging
 import os
-import random
-from itertools import product
-from typing import Dict, List
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
-from pynput import mouse
+import numpy as np
 
-from common import InputScreen, Caterpillar, MAX_CATERPILLAR_SIZE, Color, DATA_DIR, NUM_DEFAULT_CATERPILLARS
+import metrics
+from common import InputScreen, Caterpillar, Snapshot, caterpillars_from_array
+from journal import Journal
+from space import CaterpillarSpace
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 REFRESH_SPACE = 5460
 DEFAULT_THRESH = 0.05
-
-controller = mouse.Controller()
+ACTIVE_SEED_THRESH = 0.005
+ACTIVE_QUERY_SIZE = 16
+ACTIVE_HOLDOUT_SIZE = 50
+ACTIVE_ENSEMBLE_SIZE = 3
+ACTIVE_PATIENCE = 2
+ACTIVE_MIN_DELTA = 0.01
 
 
 def gen_space() -> Dict[int, List[Caterpillar]]:
-    caterpillars = {i + 1: [] for i in range(MAX_CATERPILLAR_SIZE)}
-    for to_fill in range(MAX_CATERPILLAR_SIZE):
-        to_fill = to_fill + 1
-        combinations = product([1, 2, 3, 4], repeat=to_fill)
-        for combination in combinations:
-            full_value = [Color(c) for c in combination] + [Color.Null] * (MAX_CATERPILLAR_SIZE - to_fill)
-            caterpillars[to_fill].append(Caterpillar(tuple(full_value)))
-    return caterpillars
+    space = CaterpillarSpace()
+    return {
+        length: caterpillars_from_array(space.unrank_array(space.length_range(length)))
+        for length in space.sizes
+    }
 
 
-def curate_randomly(*, name: str, thresh: float = DEFAULT_THRESH, min_caterpillars: int = 2):
+@metrics.timed('curate.random')
+def curate_randomly(*, name: str, thresh: float = DEFAULT_THRESH, min_caterpillars: int = 2,
+                    calibrate: bool = False):
     game_screen = InputScreen()
-    game_screen.init()
-
-    data_space = gen_space()
-
-    datasets = set()
-    for caterpillar_len, caterpillars in data_space.items():
-        logging.info(f'{len(caterpillars)} of length {caterpillar_len} caterpillars.')
-        dataset_idx = []
-        for idx, caterpillar in enumerate(caterpillars):
-            rand_val = random.random()
-            if rand_val < thresh:
-                dataset_idx.append(idx)
-
-        while len(dataset_idx) > min(min_caterpillars, len(caterpillars)):
-            rand_val = random.randint(0, len(caterpillars) - 1)
-            if rand_val in dataset_idx:
-                continue
-            dataset_idx.append(rand_val)
-        datasets.update(caterpillars[idx] for idx in dataset_idx)
-
-    logging.info(f'Collected all datasets')
-
-    game_screen.clear()
-    space_results = [(c.json(), game_screen.check_caterpillar(c)) for c in datasets]
-
-    os.makedirs(DATA_DIR, exist_ok=True)
-    with open(os.path.join(DATA_DIR, f'{name}.json'), 'w') as f:
-        json.dump(space_results, f)
-
-
-def curate_refresh(*, name: str, thresh: float = DEFAULT_THRESH):
+    game_screen.init(calibrate=calibrate)
+    with Journal(name) as journal:
+        # keep the same plan when resuming so journaled caterpillars are skipped instead of replaced
+        if 'seed' not in journal.meta:
+            journal.set_meta('seed', int(np.random.SeedSequence().generate_state(1)[0]))
+        space = CaterpillarSpace()
+        plan = space.stratified_sample(thresh, min_caterpillars, np.random.default_rng(journal.meta['seed']))
+
+        datasets = set()
+        for caterpillar_len, ranks in plan.items():
+            logging.info(f'{len(ranks)} of {space.sizes[caterpillar_len]} length {caterpillar_len} caterpillars.')
+            for batch in space.batches(ranks):
+                datasets.update(caterpillars_from_array(batch))
+
+        logging.info(f'Collected all datasets')
+
+        todo = [c for c in datasets if c not in journal]
+        logging.info(f'{len(datasets) - len(todo)} of {len(datasets)} caterpillars are already journaled.')
+
+        game_screen.clear()
+        start = time.perf_counter()
+        with game_screen.capturing():
+            for caterpillar in todo:
+                journal.record(caterpillar, game_screen.check_caterpillar(caterpillar))
+        elapsed = time.perf_counter() - start
+        logging.info(f'Checked {len(todo)} caterpillars at {len(todo) / max(elapsed, 1e-9) * 60:.1f} per minute.')
+        journal.dump()
+
+
+def _harvest(game_screen: InputScreen, journal: Journal, frames: 'queue.Queue[Optional[Snapshot]]', goal: int,
+             done: threading.Event):
+    # classify and journal each level's frame while the main thread is already navigating to the next one
+    try:
+        start = time.perf_counter()
+        seen = 0
+        new = 0
+        while len(journal) < goal:
+            snapshot = frames.get()
+            if snapshot is None:
+                break
+            valid_caterpillars, invalid_caterpillars = game_screen.read_caterpillars(snapshot)
+            for valid_caterpillar, invalid_caterpillar in zip(valid_caterpillars, invalid_caterpillars):
+                if valid_caterpillar == invalid_caterpillar:
+                    logging.debug('Level screen is likely open. stopping read.')
+                    break
+                new += journal.record(valid_caterpillar, True)
+                new += journal.record(invalid_caterpillar, False)
+                seen += 2
+            minutes = (time.perf_counter() - start) / 60
+            print(f'Collected {len(journal)} of {goal} caterpillars, {new / minutes:.0f} new per minute, '
+                  f'{1 - new / max(seen, 1):.0%} duplicates.')
+    finally:
+        done.set()
+
+
+@metrics.timed('curate.refresh')
+def curate_refresh(*, name: str, thresh: float = DEFAULT_THRESH, calibrate: bool = False):
     game_screen = InputScreen()
-    game_screen.init()
+    game_screen.init(calibrate=calibrate)
 
     goal = int(REFRESH_SPACE * thresh)
     print(f'Logging {goal} of {REFRESH_SPACE} total Caterpillars.')
 
-    datasets = {}
-    while len(datasets) < goal:
-        game_screen.open_level()
-        for idx in range(NUM_DEFAULT_CATERPILLARS):
-            valid_caterpillar = game_screen.valid_caterpillar(idx)
-            invalid_caterpillar = game_screen.invalid_caterpillar(idx)
-            if valid_caterpillar == invalid_caterpillar:
-                logging.debug('Level screen is likely open. stopping read.')
+    frames: 'queue.Queue[Optional[Snapshot]]' = queue.Queue()
+    done = threading.Event()
+    with Journal(name) as journal, ThreadPoolExecutor(max_workers=1) as pool, game_screen.capturing():
+        harvest = pool.submit(_harvest, game_screen, journal, frames, goal, done)
+        try:
+            while not done.is_set():
+                # open_level hands back the settled frame, reading it can wait until we are on the way out
+                frames.put(game_screen.open_level(clear=False).copy())
+                game_screen.back_out()
+        finally:
+            # also on an error or ctrl-c, otherwise the harvest thread waits for a frame forever
+            frames.put(None)
+        harvest.result()
+        journal.dump()
+
+
+@metrics.timed('curate.active')
+def curate_active(*, name: str, query_size: int = ACTIVE_QUERY_SIZE, holdout_size: int = ACTIVE_HOLDOUT_SIZE,
+                  ensemble_size: int = ACTIVE_ENSEMBLE_SIZE, patience: int = ACTIVE_PATIENCE,
+                  min_delta: float = ACTIVE_MIN_DELTA, calibrate: bool = False):
+    # torch is only needed for this mode
+    import nn
+
+    game_screen = InputScreen()
+    game_screen.init(calibrate=calibrate)
+    game_screen.clear()
+    with Journal(name) as journal, game_screen.capturing():
+        # the same holdout and seed sample on resume, so they come back from the journal instead of the game
+        if 'seed' not in journal.meta:
+            journal.set_meta('seed', int(np.random.SeedSequence().generate_state(1)[0]))
+        space = CaterpillarSpace()
+        rng = np.random.default_rng(journal.meta['seed'])
+        segments = space.unrank_array(np.arange(len(space)))
+        labels: Dict[int, bool] = {}
+        for caterpillar, valid in journal.results().items():
+            rank = space.rank(caterpillar)
+            if rank is not None:
+                labels[rank] = valid
+
+        def query(ranks: np.ndarray):
+            for rank in ranks:
+                rank = int(rank)
+                if rank not in labels:
+                    labels[rank] = game_screen.check_caterpillar(space.unrank(rank))
+                    journal.record(space.unrank(rank), labels[rank])
+
+        holdout = rng.choice(len(space), size=holdout_size, replace=False)
+        query(holdout)
+        holdout_labels = np.array([labels[int(r)] for r in holdout])
+        holdout_set = set(holdout.tolist())
+        for ranks in space.stratified_sample(ACTIVE_SEED_THRESH, 2, rng).values():
+            query(ranks)
+
+        best_acc = 0.0
+        stale = 0
+        while True:
+            train_ranks = np.array([r for r in labels if r not in holdout_set])
+            train_labels = np.array([labels[r] for r in train_ranks], dtype=np.float32)
+            nets = [nn.fit(segments[train_ranks], train_labels, verbose=False)[0] for _ in range(ensemble_size)]
+            probs = np.stack([nn.predict_proba(net, segments) for net in nets])
+            mean = probs.mean(axis=0)
+
+            acc = float(((mean[holdout] > 0.5) == holdout_labels).mean())
+            print(f'{len(labels)} queries | Held-out Acc: {acc:.3f}')
+            if acc > best_acc + min_delta:
+                best_acc = acc
+                stale = 0
+            else:
+                stale += 1
+            if acc == 1.0 or stale >= patience:
                 break
-            datasets[valid_caterpillar] = True
-            datasets[invalid_caterpillar] = False
-        print(f'Collected {len(datasets)} of {goal} caterpillars.')
-        game_screen.back_out()
 
-    space_results = [(c.json(), v) for c, v in datasets.items()]
-    os.makedirs(DATA_DIR, exist_ok=True)
-    with open(os.path.join(DATA_DIR, f'{name}.json'), 'w') as f:
-        json.dump(space_results, f)
+            # least sure is closest to 0.5, plus wherever the ensemble disagrees
+            uncertainty = probs.std(axis=0) - np.abs(mean - 0.5)
+            uncertainty[list(labels)] = -np.inf
+            query(np.argsort(-uncertainty)[:query_size])
+
+        logging.info(f'Used {len(labels)} queries for a held-out accuracy of {best_acc:.3f}.')
+        journal.dump()
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--thresh', default=DEFAULT_THRESH)
+    parser.add_argument('--mode', choices=['refresh', 'random', 'active'], default='refresh')
+    parser.add_argument('--thresh', type=float, default=DEFAULT_THRESH)
+    parser.add_argument('--calibrate', action='store_true',
+                        help='find the shortest click delay the game keeps up with, the level must be open')
     args = parser.parse_args()
 
-    curate_refresh(
-        name=input('Open the level and enter the level name'),
-        thresh=args.thresh
-    )
+    name = input('Open the level and enter the level name')
+    if args.mode == 'refresh':
+        curate_refresh(name=name, thresh=args.thresh, calibrate=args.calibrate)
+    elif args.mode == 'random':
+        curate_randomly(name=name, thresh=args.thresh, calibrate=args.calibrate)
+    else:
+        curate_active(name=name, calibrate=args.calibrate)
 
 
 if __name__ == '__main__':
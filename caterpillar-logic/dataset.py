@@ -0,0 +1,118 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import struct
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from common import DATA_DIR, MAX_CATERPILLAR_SIZE, caterpillars_to_array, load_results
+
+MAGIC = b'CATD'
+VERSION = 1
+# magic, version, segments per row, reserved, rows, metadata length
+HEADER = struct.Struct('<4sHBBII')
+ALIGNMENT = 8
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def dataset_path(name: str) -> str:
+    return os.path.join(DATA_DIR, f'{name}.catd')
+
+
+def write_dataset(path: str, segments: np.ndarray, labels: np.ndarray, meta: Optional[Dict] = None):
+    segments = np.ascontiguousarray(segments, dtype=np.uint8).reshape(-1, MAX_CATERPILLAR_SIZE)
+    labels = np.asarray(labels, dtype=bool)
+    assert len(segments) == len(labels)
+
+    meta_bytes = json.dumps(meta or {}).encode('utf-8')
+    header = HEADER.pack(MAGIC, VERSION, MAX_CATERPILLAR_SIZE, 0, len(segments), len(meta_bytes)) + meta_bytes
+    # write to the side and swap in so a reader never maps a half written file
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(b'\0' * (_aligned(len(header)) - len(header)))
+        f.write(segments.tobytes())
+        f.write(np.packbits(labels).tobytes())
+    os.replace(tmp_path, path)
+
+
+class PackedDataset:
+    def __init__(self, path: str):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, width, _, count, meta_len = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} caterpillar dataset')
+
+        offset = HEADER.size + meta_len
+        self.meta: Dict = json.loads(bytes(self.buffer[HEADER.size:offset]))
+        offset = _aligned(offset)
+        self.segments = self.buffer[offset:offset + count * width].reshape(count, width)
+        offset += count * width
+        self.label_bits = self.buffer[offset:offset + (count + 7) // 8]
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def labels(self) -> np.ndarray:
+        return np.unpackbits(self.label_bits, count=len(self)).astype(bool)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return (self.segments > 0).sum(axis=1)
+
+    def split(self, validation: float, rng: Optional[np.random.Generator] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if rng is None:
+            rng = np.random.default_rng()
+        valid = rng.random(len(self)) < validation
+        # the shortest caterpillars are too few to hold out, so they are trained on as well
+        train = ~valid | (self.lengths <= 2)
+        return np.flatnonzero(train), np.flatnonzero(valid)
+
+    def tensors(self):
+        import torch
+        return torch.from_numpy(np.array(self.segments)), torch.from_numpy(self.labels)
+
+
+def convert_json(name: str) -> str:
+    results = load_results(os.path.join(DATA_DIR, f'{name}.json'))
+    path = dataset_path(name)
+    write_dataset(path, caterpillars_to_array(results), np.array(list(results.values()), dtype=bool),
+                  {'name': name, 'source': f'{name}.json'})
+    logging.info(f'Converted {len(results)} caterpillars to {path}')
+    return path
+
+
+def load_dataset(name: str) -> PackedDataset:
+    path = dataset_path(name)
+    json_path = os.path.join(DATA_DIR, f'{name}.json')
+    # curation only writes json, regenerate the packed copy when it is missing or stale
+    if not os.path.exists(path) or (os.path.exists(json_path) and os.path.getmtime(json_path) > os.path.getmtime(path)):
+        convert_json(name)
+    return PackedDataset(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['convert'])
+    parser.add_argument('--name', help='level to convert, defaults to every json dataset')
+    args = parser.parse_args()
+
+    if args.name:
+        names = [args.name]
+    else:
+        names = [os.path.basename(p)[:-len('.json')] for p in sorted(glob.glob(os.path.join(DATA_DIR, '*.json')))]
+    for name in names:
+        convert_json(name)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+from common import DATA_DIR, Caterpillar, dump_results
+
+
+class Journal:
+    def __init__(self, name: str):
+        self.name = name
+        self.path = os.path.join(DATA_DIR, f'{name}.journal')
+        self.index: Dict[Caterpillar, bool] = {}
+        self.meta: Dict[str, object] = {}
+
+        # names may point into a subdirectory of data, like the simulator's sim/<rule>
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        needs_newline = False
+        if os.path.exists(self.path):
+            needs_newline = self._replay()
+        self.file = open(self.path, 'a')
+        if needs_newline:
+            # do not glue the next record onto a line cut short by a crash
+            self.file.write('\n')
+        logging.info(f'Resuming from {len(self.index)} journaled caterpillars.')
+
+    def _replay(self) -> bool:
+        with open(self.path, 'r') as f:
+            lines = f.read().split('\n')
+        for line in lines:
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f'Skipping a partial record in {self.path}: {line}')
+                continue
+            if isinstance(record, dict):
+                self.meta.update(record)
+            else:
+                values, valid = record
+                self.index[Caterpillar.from_json(values)] = bool(valid)
+        return lines[-1] != ''
+
+    def __enter__(self) -> 'Journal':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, caterpillar: Caterpillar) -> bool:
+        return caterpillar in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, caterpillar: Caterpillar) -> Optional[bool]:
+        return self.index.get(caterpillar)
+
+    def _append(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def set_meta(self, key: str, value):
+        self.meta[key] = value
+        self._append({key: value})
+
+    def record(self, caterpillar: Caterpillar, valid: bool) -> bool:
+        if caterpillar in self.index:
+            return False
+        self._append([caterpillar.json(), valid])
+        self.index[caterpillar] = valid
+        return True
+
+    def results(self) -> Dict[Caterpillar, bool]:
+        return dict(self.index)
+
+    def dump(self):
+        dump_results(os.path.join(DATA_DIR, f'{self.name}.json'), self.index)
+
+    def close(self):
+        self.file.close()
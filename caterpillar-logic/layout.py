@@ -0,0 +1,218 @@
+import argparse
+import json
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from common import CLICK_DELAY, MAX_CATERPILLAR_SIZE, NUM_DEFAULT_CATERPILLARS, Color
+
+BACKGROUND_TOLERANCE = 24
+PALETTE_TOLERANCE = 40
+MIN_BLOB_AREA = 12
+NUM_INPUT_BUTTONS = 6
+
+
+@dataclass
+class Blob:
+    area: int
+    x: int
+    y: int
+    width: int
+    height: int
+    color: Tuple[int, int, int]
+
+    @property
+    def xy(self) -> Tuple[int, int]:
+        return self.x, self.y
+
+
+def _runs(row: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    edges = np.diff(np.concatenate([[0], row.astype(np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def find_blobs(pixels: np.ndarray, min_area: int = MIN_BLOB_AREA) -> List[Blob]:
+    pixels = np.asarray(pixels)[..., :3].astype(np.int32)
+    # the background is whatever color covers most of the screen
+    colors, counts = np.unique(pixels[::4, ::4].reshape(-1, 3), axis=0, return_counts=True)
+    background = colors[counts.argmax()]
+    mask = np.abs(pixels - background).max(axis=-1) > BACKGROUND_TOLERANCE
+
+    # label runs of foreground pixels row by row, joining runs that overlap the row above
+    parent: List[int] = []
+    runs: List[Tuple[int, int, int]] = []
+    previous: List[Tuple[int, int, int]] = []
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for y in range(mask.shape[0]):
+        starts, ends = _runs(mask[y])
+        current = []
+        j = 0
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            label = len(parent)
+            parent.append(label)
+            runs.append((y, start, end))
+            current.append((start, end, label))
+            while j < len(previous) and previous[j][1] <= start:
+                j += 1
+            k = j
+            while k < len(previous) and previous[k][0] < end:
+                a, b = find(label), find(previous[k][2])
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+                k += 1
+        previous = current
+
+    stats: Dict[int, List[int]] = {}
+    for label, (y, start, end) in enumerate(runs):
+        s = stats.setdefault(find(label), [0, 0, 0, start, y, end, y + 1])
+        n = end - start
+        s[0] += n
+        s[1] += (start + end - 1) * n
+        s[2] += 2 * y * n
+        s[3], s[4], s[5], s[6] = min(s[3], start), min(s[4], y), max(s[5], end), max(s[6], y + 1)
+
+    blobs = []
+    for area, sx, sy, x0, y0, x1, y1 in stats.values():
+        if area < min_area:
+            continue
+        x, y = round(sx / (2 * area)), round(sy / (2 * area))
+        # the center pixel is what gets sampled later, antialiased edges would skew a mean
+        blobs.append(Blob(area, x, y, x1 - x0, y1 - y0, tuple(int(c) for c in pixels[y, x])))
+    return blobs
+
+
+def _distance(a: Tuple[int, int, int], b: Tuple[int, int, int]) -> int:
+    return max(abs(e1 - e2) for e1, e2 in zip(a, b))
+
+
+def _rows(blobs: List[Blob]) -> List[List[Blob]]:
+    # blobs whose centers are within half a blob height of each other share a row
+    rows: List[List[Blob]] = []
+    for blob in sorted(blobs, key=lambda b: b.y):
+        if rows and blob.y - rows[-1][-1].y <= max(2, blob.height // 2):
+            rows[-1].append(blob)
+        else:
+            rows.append([blob])
+    return [sorted(row, key=lambda b: b.x) for row in rows]
+
+
+def _input_buttons(blobs: List[Blob]) -> Optional[List[Blob]]:
+    best = None
+    for row in _rows(blobs):
+        for i in range(len(row) - NUM_INPUT_BUTTONS + 1):
+            buttons = row[i:i + NUM_INPUT_BUTTONS]
+            areas = [b.area for b in buttons]
+            if max(areas) > 1.5 * min(areas):
+                continue
+            colors = [b.color for b in buttons[:4]]
+            if any(_distance(a, b) <= PALETTE_TOLERANCE for n, a in enumerate(colors) for b in colors[n + 1:]):
+                continue
+            # the biggest row of six buttons wins, caterpillar segments are smaller
+            if best is None or min(areas) > min(b.area for b in best):
+                best = buttons
+    return best
+
+
+def _caterpillars(segments: List[Blob]) -> Tuple[float, List[List[Blob]]]:
+    # spacing between neighbouring segments, ignoring the gap between the valid and invalid caterpillars
+    gaps = [b.x - a.x for row in _rows(segments) for a, b in zip(row, row[1:])]
+    if not gaps:
+        return 0.0, []
+    spacing = float(np.median([g for g in gaps if g <= 1.5 * min(gaps)]))
+    caterpillars = []
+    for row in _rows(segments):
+        caterpillars.append([row[0]])
+        for a, b in zip(row, row[1:]):
+            if b.x - a.x > 1.5 * spacing:
+                caterpillars.append([])
+            caterpillars[-1].append(b)
+    return spacing, caterpillars
+
+
+def _segment_locs(first: Blob, spacing: float) -> List[Tuple[int, int]]:
+    return [(round(first.x + i * spacing), first.y) for i in range(MAX_CATERPILLAR_SIZE)]
+
+
+def _palette_segments(blobs: List[Blob], palette: List[Tuple[int, int, int]], max_area: float) -> List[Blob]:
+    return [b for b in blobs
+            if b.area < max_area and min(_distance(b.color, c) for c in palette) <= PALETTE_TOLERANCE]
+
+
+def detect_input_layout(pixels: np.ndarray) -> Optional[Dict]:
+    blobs = find_blobs(pixels)
+    buttons = _input_buttons(blobs)
+    if buttons is None:
+        logging.info('Could not find the input buttons.')
+        return None
+    palette = [b.color for b in buttons[:4]]
+    segments = _palette_segments([b for b in blobs if b not in buttons], palette, min(b.area for b in buttons))
+    spacing, caterpillars = _caterpillars(segments)
+    if not caterpillars:
+        logging.info('Could not find any caterpillars.')
+        return None
+
+    # caterpillars are left-filled, so the first segments line up in one column for valid and one for invalid
+    firsts = sorted(c[0].x for c in caterpillars)
+    columns = [[firsts[0]]]
+    for x in firsts[1:]:
+        if x - columns[-1][-1] > spacing / 2:
+            columns.append([])
+        columns[-1].append(x)
+    if len(columns) != 2:
+        logging.info(f'Expected a valid and an invalid column of caterpillars, found {len(columns)}.')
+        return None
+    valid = sorted((c[0] for c in caterpillars if c[0].x in columns[0]), key=lambda b: b.y)
+    invalid = sorted((c[0] for c in caterpillars if c[0].x in columns[1]), key=lambda b: b.y)
+    if len(valid) != NUM_DEFAULT_CATERPILLARS or len(invalid) != NUM_DEFAULT_CATERPILLARS:
+        logging.info(f'Expected {NUM_DEFAULT_CATERPILLARS} caterpillars per column, '
+                     f'found {len(valid)} valid and {len(invalid)} invalid.')
+        return None
+
+    names = ['red', 'green', 'blue', 'grey', 'backspace', 'ok']
+    settings = {name: b.xy for name, b in zip(names, buttons)}
+    settings.update({
+        'click_delay': CLICK_DELAY,
+        'offsets': [(0, b.y - valid[0].y) for b in valid],
+        'valid': _segment_locs(valid[0], spacing),
+        'invalid': _segment_locs(invalid[0], spacing),
+    })
+    return settings
+
+
+def detect_test_caterpillar(pixels: np.ndarray,
+                            color_lookup: Dict[Tuple[int, int, int], Color]) -> Optional[List[Tuple[int, int]]]:
+    palette = [raw[:3] for raw, color in color_lookup.items() if color != Color.Null]
+    blobs = find_blobs(pixels)
+    segments = _palette_segments(blobs, palette, max(b.area for b in blobs) + 1) if blobs else []
+    spacing, caterpillars = _caterpillars(segments)
+    # the test caterpillar needs two segments to know the spacing
+    caterpillars = [c for c in caterpillars if len(c) > 1]
+    if len(caterpillars) != 1:
+        logging.info(f'Expected one test caterpillar, found {len(caterpillars)}.')
+        return None
+    return _segment_locs(caterpillars[0][0], spacing)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('screenshot', help='detect the input screen layout in this image')
+    args = parser.parse_args()
+
+    settings = detect_input_layout(np.asarray(Image.open(args.screenshot).convert('RGB')))
+    if settings is None:
+        raise AssertionError(f'Could not detect a layout in {args.screenshot}')
+    print(json.dumps(settings))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from typing import Callable, ContextManager, Dict, List
+
+# set to 1 for a report in data/metrics, or to the path of the report
+ENV_VAR = 'CATERPILLAR_METRICS'
+METRICS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'metrics')
+ENABLED = os.environ.get(ENV_VAR, '') not in ('', '0')
+# four buckets per doubling from a microsecond to about a minute, so a percentile is off by at most 19%
+BUCKET_BASE = 1e-6
+BUCKETS_PER_DOUBLING = 4
+NUM_BUCKETS = 27 * BUCKETS_PER_DOUBLING
+PERCENTILES = [50, 90, 99]
+
+_NULL = contextlib.nullcontext()
+_lock = threading.Lock()
+_start = time.time()
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = [0] * NUM_BUCKETS
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        index = 0 if seconds <= BUCKET_BASE else math.ceil(math.log2(seconds / BUCKET_BASE) * BUCKETS_PER_DOUBLING)
+        self.buckets[min(index, NUM_BUCKETS - 1)] += 1
+
+    @staticmethod
+    def bound(index: int) -> float:
+        return BUCKET_BASE * 2 ** (index / BUCKETS_PER_DOUBLING)
+
+    def percentile(self, q: float) -> float:
+        # the upper bound of the bucket the percentile falls in, never past the largest value seen
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(self.bound(i), self.max)
+        return self.max
+
+    def report(self) -> Dict:
+        report = {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+        }
+        report.update({f'p{q}': self.percentile(q) for q in PERCENTILES})
+        report['buckets'] = {f'{self.bound(i):.2e}': n for i, n in enumerate(self.buckets) if n}
+        return report
+
+
+_timers: Dict[str, Histogram] = {}
+_counters: Dict[str, int] = {}
+
+
+def observe(name: str, seconds: float):
+    if not ENABLED:
+        return
+    with _lock:
+        if name not in _timers:
+            _timers[name] = Histogram()
+        _timers[name].add(seconds)
+
+
+def count(name: str, n: int = 1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+@contextlib.contextmanager
+def _timer(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timer(name: str) -> ContextManager:
+    return _timer(name) if ENABLED else _NULL
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    def decorator(fn: Callable) -> Callable:
+        # decided once at import, so a disabled run calls the function itself
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def report() -> Dict:
+    with _lock:
+        return {
+            'argv': sys.argv,
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(_start)),
+            'seconds': time.time() - _start,
+            'timers': {name: h.report() for name, h in sorted(_timers.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+
+def report_path() -> str:
+    value = os.environ.get(ENV_VAR, '')
+    if value not in ('1', 'true'):
+        return value
+    script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+    return os.path.join(METRICS_DIR, f'{script}-{time.strftime("%Y%m%d-%H%M%S", time.localtime(_start))}.json')
+
+
+def dump(path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+    logging.info(f'Wrote metrics to {path}')
+
+
+def _dump_at_exit():
+    if _timers or _counters:
+        dump(report_path())
+
+
+if ENABLED:
+    atexit.register(_dump_at_exit)
+
+
+def print_report(data: Dict):
+    print(f'{" ".join(data["argv"])}: {data["seconds"]:.1f} s from {data["start"]}')
+    timers: List = sorted(data['timers'].items(), key=lambda kv: -kv[1]['total'])
+    width = max([len(name) for name in data['timers']] + [len(name) for name in data['counters']] + [5])
+    print(f'{"timer":<{width}} {"count":>8} {"total s":>9} {"share":>6} {"mean ms":>9} {"p50 ms":>8} {"p99 ms":>8}')
+    for name, t in timers:
+        print(f'{name:<{width}} {t["count"]:>8} {t["total"]:>9.2f} {t["total"] / data["seconds"]:>6.1%} '
+              f'{t["mean"] * 1000:>9.3f} {t["p50"] * 1000:>8.3f} {t["p99"] * 1000:>8.3f}')
+    for name, n in data['counters'].items():
+        print(f'{name:<{width}} {n:>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('report', help=f'a report written with {ENV_VAR} set')
+    args = parser.parse_args()
+
+    with open(args.report, 'r') as f:
+        print_report(json.load(f))
+
+
+if __name__ == '__main__':
+    main()
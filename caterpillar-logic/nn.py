@@ -1,23 +1,34 @@
 import argparse
-import json
+import copy
 import logging
 import os
-import random
+import math
+import sys
 import time
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.optim import Adam
+from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.utils.data import DataLoader
 
-from common import DATA_DIR, Caterpillar, Color, TestScreen
+import metrics
+from common import DATA_DIR, model_fingerprint
+from dataset import load_dataset
+from npnn import NumpyNN, net_weights, weights_path
+from verdicts import SPACE, VerdictTable
 
 EPOCHS = 50
 BATCH_SIZE = 16
 LEARN_RATE = 0.005
+PATIENCE = 8
+LR_PATIENCE = 3
+LR_FACTOR = 0.5
+MIN_DELTA = 1e-4
+LOADERS = ['tensor', 'dataloader']
+PLOTS = ['show', 'save', 'off']
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -71,53 +82,70 @@ def binary_acc(y_pred, y_test):
     return acc
 
 
-def train(*, name: str, validation: float = 0.1):
-    data_file = os.path.join(DATA_DIR, f'{name}.json')
-    with open(data_file, 'r') as f:
-        data = json.load(f)
-
-    train_data = []
-    valid_data = []
-    for idx, d in enumerate(data):
-        cat_info, value = d
-        caterpillar = Caterpillar(tuple([Color(c) for c in cat_info]))
-        if random.random() < validation:
-            valid_data.append(d)
-            if len(caterpillar) <= 2:
-                train_data.append(d)
-        else:
-            train_data.append(d)
+def tensor_batches(x_all: torch.Tensor, y_all: torch.Tensor, x_shuffled: torch.Tensor, y_shuffled: torch.Tensor,
+                   batch_size: int = BATCH_SIZE) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    # shuffle into the preallocated buffers, every minibatch is then a view without any collation
+    perm = torch.randperm(len(x_all), device=x_all.device)
+    torch.index_select(x_all, 0, perm, out=x_shuffled)
+    torch.index_select(y_all, 0, perm, out=y_shuffled)
+    for start in range(0, len(x_all), batch_size):
+        yield x_shuffled[start:start + batch_size], y_shuffled[start:start + batch_size]
+
 
-    training_data = Dataset(train_data)
-    train_loader = DataLoader(dataset=training_data, batch_size=BATCH_SIZE, shuffle=True)
-    validation_data = Dataset(valid_data)
-    valid_loader = DataLoader(dataset=validation_data, batch_size=BATCH_SIZE, shuffle=True)
+def loader_batches(train_loader: DataLoader, device: torch.device) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    for x_train, y_train in train_loader:
+        yield x_train.to(device).float(), y_train.to(device).float().unsqueeze(1)
 
-    logging.info(f'Using {len(training_data)} sets for training and {len(validation_data)} for validation.')
 
+def fit(x: np.ndarray, y: np.ndarray, *, epochs: int = EPOCHS, loader: str = 'tensor',
+        learn_rate: float = LEARN_RATE, batch_size: int = BATCH_SIZE,
+        valid: Optional[Tuple[np.ndarray, np.ndarray]] = None, patience: int = PATIENCE,
+        lr_patience: int = LR_PATIENCE, verbose: bool = True) -> Tuple[NN, List[float], List[float]]:
+    assert loader in LOADERS, loader
     net = NN()
-    print(net)
+    if verbose:
+        print(net)
 
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda:0" if use_cuda else "cpu")
     net.to(device)
 
+    if loader == 'tensor':
+        x_all = torch.as_tensor(np.asarray(x), dtype=torch.float32, device=device)
+        y_all = torch.as_tensor(np.asarray(y), dtype=torch.float32, device=device).unsqueeze(1)
+        x_shuffled, y_shuffled = torch.empty_like(x_all), torch.empty_like(y_all)
+    else:
+        train_loader = DataLoader(dataset=Dataset(list(zip(x, y))), batch_size=batch_size, shuffle=True)
+    num_batches = math.ceil(len(x) / batch_size)
+    if valid is not None:
+        x_valid = torch.as_tensor(np.asarray(valid[0]), dtype=torch.float32, device=device)
+        y_valid = torch.as_tensor(np.asarray(valid[1]), dtype=torch.float32, device=device).unsqueeze(1)
+
     criterion = nn.BCEWithLogitsLoss()
-    optimizer = Adam(net.parameters(), lr=LEARN_RATE)
+    optimizer = Adam(net.parameters(), lr=learn_rate)
+    scheduler = ReduceLROnPlateau(optimizer, factor=LR_FACTOR, patience=lr_patience)
 
     losses = []
     accuracies = []
-    for epoch in range(EPOCHS):
+    throughputs = []
+    best_loss = math.inf
+    best_epoch = 0
+    best_state = None
+    for epoch in range(epochs):
         epoch_loss = 0
         epoch_acc = 0
-        for x_train, y_train in train_loader:
-            x_train, y_train = x_train.to(device), y_train.to(device)
+        start = time.perf_counter()
+        if loader == 'tensor':
+            batches = tensor_batches(x_all, y_all, x_shuffled, y_shuffled, batch_size)
+        else:
+            batches = loader_batches(train_loader, device)
+        for x_train, y_train in batches:
             optimizer.zero_grad()
 
-            y_pred = net(x_train.float())
+            y_pred = net(x_train)
 
-            loss = criterion(y_pred, y_train.unsqueeze(1))
-            acc = binary_acc(y_pred, y_train.unsqueeze(1))
+            loss = criterion(y_pred, y_train)
+            acc = binary_acc(y_pred, y_train)
 
             loss.backward()
             optimizer.step()
@@ -125,22 +153,118 @@ def train(*, name: str, validation: float = 0.1):
             epoch_loss += loss.item()
             epoch_acc += acc.item()
 
-        losses.append(epoch_loss / len(train_loader))
-        accuracies.append(epoch_acc / len(train_loader))
+        losses.append(epoch_loss / num_batches)
+        accuracies.append(epoch_acc / num_batches)
+        throughputs.append(len(x) / (time.perf_counter() - start))
+        metrics.observe('nn.epoch', time.perf_counter() - start)
+        metrics.count('nn.samples', len(x))
+
+        valid_str = ''
+        if valid is not None:
+            net.eval()
+            with torch.set_grad_enabled(False):
+                y_pred = net(x_valid)
+                valid_loss = criterion(y_pred, y_valid).item()
+                valid_acc = binary_acc(y_pred, y_valid).item()
+            net.train()
+            scheduler.step(valid_loss)
+            valid_str = f'| Valid Loss: {valid_loss:.5f} | Valid Acc: {valid_acc:.3f} '
+            if valid_loss < best_loss - MIN_DELTA:
+                best_loss = valid_loss
+                best_epoch = epoch
+                best_state = copy.deepcopy(net.state_dict())
+
+        if verbose:
+            print(f'Epoch {epoch + 0:03}: '
+                  f'| Loss: {losses[-1]:.5f} '
+                  f'| Acc: {accuracies[-1]:.3f} '
+                  f'{valid_str}'
+                  f'| {throughputs[-1]:.0f} samples/s')
+
+        if valid is not None and epoch - best_epoch >= patience:
+            logging.info(f'Stopping early at epoch {epoch}, validation loss has not improved since epoch {best_epoch}.')
+            break
+    if best_state is not None:
+        # keep the best model, not the last
+        net.load_state_dict(best_state)
+        logging.info(f'Restored the best model from epoch {best_epoch} with a validation loss of {best_loss:.5f}.')
+    if throughputs:
+        logging.info(f'Trained {len(losses)} epochs at {np.mean(throughputs):.0f} samples/s with the {loader} loader.')
+    return net, losses, accuracies
+
+
+def predict_proba(net: NN, x: np.ndarray) -> np.ndarray:
+    net.eval()
+    device = next(net.parameters()).device
+    with torch.set_grad_enabled(False):
+        y = torch.sigmoid(net(torch.from_numpy(np.asarray(x)).float().to(device)))
+    return y.squeeze(1).cpu().numpy()
 
-        print(f'Epoch {epoch + 0:03}: '
-              f'| Loss: {losses[-1]:.5f} '
-              f'| Acc: {accuracies[-1]:.3f}')
 
-    final_acc = 0
+def load_net(name: str) -> NN:
+    net = NN()
+    state_dict = torch.load(os.path.join(DATA_DIR, f'{name}.torch'), map_location='cpu')
+    missing, unexpected = net.load_state_dict(state_dict, strict=False)
+    if missing or unexpected:
+        # dropping or defaulting layers would silently serve a different function than the one trained
+        layers = sorted({k.split('.')[0] for k in missing + unexpected})
+        raise RuntimeError(f'{name}.torch was saved by a different model ({", ".join(layers)} do not match), '
+                           f'retrain it with "nn.py train --name {name}"')
+    net.eval()
+    return net
+
+
+def compile_verdicts(*, name: str):
+    net = load_net(name)
+    start = time.perf_counter()
+    probabilities = predict_proba(net, SPACE.unrank_array(np.arange(len(SPACE))))
+    table = VerdictTable.from_probabilities(probabilities, model_fingerprint(name))
+    table.save(name)
+    logging.info(f'Compiled {len(SPACE)} verdicts for {name} in {(time.perf_counter() - start) * 1000:.1f} ms, '
+                 f'{table.verdicts.mean():.1%} valid.')
+
+
+def export_weights(*, name: str):
+    net = load_net(name)
+    weights = net_weights(net)
+    # checked before saving, a copy that disagrees with torch must never reach play or serve
+    check_parity(name=name, net=net, np_net=NumpyNN(weights))
+    np.savez(weights_path(name), source=np.array(model_fingerprint(name)), **weights)
+    logging.info(f'Exported {len(weights)} weight arrays to {weights_path(name)}')
+
+
+def check_parity(*, name: str, net: NN = None, np_net: NumpyNN = None):
+    if net is None:
+        net = load_net(name)
+    if np_net is None:
+        np_net = NumpyNN.load(name)
+    x = SPACE.unrank_array(np.arange(len(SPACE)))
     with torch.set_grad_enabled(False):
-        for x_valid, y_valid in valid_loader:
-            x_valid, y_valid = x_valid.to(device), y_valid.to(device)
-            y_pred = net(x_valid.float())
-            acc = binary_acc(y_pred, y_valid.unsqueeze(1))
-            final_acc += acc.item()
-        print(f'Validation Acc: {final_acc / len(valid_loader):.3f}')
-    torch.save(net.state_dict(), os.path.join(DATA_DIR, f'{name}.torch'))
+        torch_logits = net(torch.from_numpy(x).float())
+        torch_pred = pred(torch_logits).squeeze(1).numpy().astype(bool)
+    max_diff = float(np.abs(np_net.forward(x) - torch_logits.numpy()).max())
+    mismatches = int((np_net.pred(x) != torch_pred).sum())
+    logging.info(f'{name}: max logit difference {max_diff:.2e}, {mismatches} of {len(x)} verdicts differ.')
+    if mismatches:
+        raise AssertionError(f'NumPy and torch verdicts differ for {mismatches} caterpillars')
+
+
+def _has_display() -> bool:
+    if sys.platform in ('win32', 'darwin'):
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def plot_training(name: str, losses: List[float], accuracies: List[float], show: bool):
+    try:
+        import matplotlib
+    except ImportError:
+        logging.info('matplotlib is not installed, skipping the training plot.')
+        return
+    if not show:
+        # render straight to the file, a headless worker has no window to open
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
     fig, (ax1, ax2) = plt.subplots(2, 1)
     fig.set_size_inches(16, 9)
@@ -150,44 +274,66 @@ def train(*, name: str, validation: float = 0.1):
     ax2.set_title('Accuracies')
     fig.savefig(os.path.join(DATA_DIR, f'{name}.png'))
 
-    plt.show()
+    if show:
+        plt.show()
+    plt.close(fig)
 
 
-def test(*, name: str):
-    net = NN()
-    net.load_state_dict(torch.load(os.path.join(DATA_DIR, f'{name}.torch')))
+@metrics.timed('nn.train')
+def train(*, name: str, validation: float = 0.1, loader: str = 'tensor', plot: Optional[str] = None):
+    if plot is None:
+        plot = 'show' if _has_display() else 'save'
+    assert plot in PLOTS, plot
+    data = load_dataset(name)
+    segments, labels = data.segments, data.labels
+    train_idx, valid_idx = data.split(validation)
 
-    test_screen = TestScreen()
-    test_screen.init()
+    logging.info(f'Using {len(train_idx)} sets for training and {len(valid_idx)} for validation.')
 
-    with torch.set_grad_enabled(False):
-        while 1:
-            val = input('Press enter to read the caterpillar. (q to quit)').lower()
-            if val == 'q':
-                break
-            caterpillar = test_screen.test_caterpillar()
-            res = net(torch.from_numpy(np.array(caterpillar.json())).float())
-            bool_res = bool(pred(res))
-            if bool_res:
-                print(f'{caterpillar} is Valid')
-                # test_screen.valid.click()
-            else:
-                print(f'{caterpillar} is Invalid')
-                # test_screen.invalid.click()
-            time.sleep(1)
+    valid = (segments[valid_idx], labels[valid_idx]) if len(valid_idx) else None
+    net, losses, accuracies = fit(segments[train_idx], labels[train_idx], loader=loader, valid=valid)
+
+    if valid is not None:
+        device = next(net.parameters()).device
+        x_valid = torch.as_tensor(np.asarray(valid[0]), dtype=torch.float32, device=device)
+        y_valid = torch.as_tensor(valid[1], dtype=torch.float32, device=device).unsqueeze(1)
+        net.eval()
+        with torch.set_grad_enabled(False):
+            print(f'Validation Acc: {binary_acc(net(x_valid), y_valid).item():.3f}')
+    else:
+        logging.info('No caterpillars were held out, skipping validation.')
+    torch.save(net.state_dict(), os.path.join(DATA_DIR, f'{name}.torch'))
+
+    if plot != 'off':
+        plot_training(name, losses, accuracies, show=plot == 'show')
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('mode', choices=['train', 'test'])
+    parser.add_argument('mode', choices=['train', 'test', 'compile', 'export'])
     parser.add_argument('--name', required=True)
+    parser.add_argument('--loader', choices=LOADERS, default='tensor')
+    parser.add_argument('--plot', choices=PLOTS, help='what to do with the training plot, '
+                                                      'defaults to show with a display and save without one')
+    parser.add_argument('--auto', action='store_true', help='test hands-free, clicking each verdict')
+    parser.add_argument('--count', type=int, help='stop --auto after this many tests')
     args = parser.parse_args()
 
     if args.mode == 'train':
-        train(name=args.name)
+        train(name=args.name, loader=args.loader, plot=args.plot)
+    elif args.mode == 'compile':
+        compile_verdicts(name=args.name)
+    elif args.mode == 'export':
+        export_weights(name=args.name)
     else:
-        test(name=args.name)
+        # testing needs no torch, play.py does it without the import
+        import play
+        if args.auto:
+            play.auto_test(name=args.name, count=args.count)
+        else:
+            play.test(name=args.name)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     main()
@@ -0,0 +1,76 @@
+import logging
+import os
+from typing import Dict, Optional
+
+import numpy as np
+
+from common import DATA_DIR, model_fingerprint
+
+# same layers, in the same order, as nn.NN
+LAYERS = ['layer_1', 'layer_2', 'layer_3', 'layer_4', 'layer_out']
+
+
+def weights_path(name: str) -> str:
+    return os.path.join(DATA_DIR, f'{name}.weights.npz')
+
+
+def net_weights(net) -> Dict[str, np.ndarray]:
+    # any module with nn.NN's layers, reading its state dict does not need torch imported here
+    return {k: v.detach().cpu().numpy() for k, v in net.state_dict().items() if k.split('.')[0] in LAYERS}
+
+
+def sigmoid(y: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-y))
+
+
+class NumpyNN:
+    def __init__(self, weights: Dict[str, np.ndarray], source: Optional[str] = ''):
+        # keep the weights transposed so a batch is x @ w + b
+        self.layers = [
+            (np.ascontiguousarray(weights[f'{layer}.weight'].T, dtype=np.float32),
+             np.asarray(weights[f'{layer}.bias'], dtype=np.float32))
+            for layer in LAYERS
+        ]
+        # the model_fingerprint of the model the weights were exported from
+        self.source = source
+
+    @classmethod
+    def from_net(cls, net, source: Optional[str] = '') -> 'NumpyNN':
+        return cls(net_weights(net), source)
+
+    @classmethod
+    def load(cls, name: str) -> 'NumpyNN':
+        with np.load(weights_path(name)) as f:
+            weights = dict(f)
+        # weights exported before sources were recorded match no model
+        source = str(weights.pop('source')) if 'source' in weights else None
+        return cls(weights, source)
+
+    @classmethod
+    def load_current(cls, name: str) -> Optional['NumpyNN']:
+        if not cls.exists(name):
+            return None
+        net = cls.load(name)
+        if net.source != model_fingerprint(name):
+            logging.warning(f'{name}.weights.npz was not exported from the current {name}.torch, ignoring it. '
+                            f'Export it again with "nn.py export --name {name}".')
+            return None
+        return net
+
+    @staticmethod
+    def exists(name: str) -> bool:
+        return os.path.exists(weights_path(name))
+
+    def forward(self, x: np.ndarray) -> np.ndarray:
+        x = np.asarray(x, dtype=np.float32)
+        for w, b in self.layers[:-1]:
+            x = np.maximum(x @ w + b, 0)
+        w, b = self.layers[-1]
+        return x @ w + b
+
+    def predict_proba(self, x: np.ndarray) -> np.ndarray:
+        return sigmoid(self.forward(x))[..., 0]
+
+    def pred(self, x: np.ndarray) -> np.ndarray:
+        # the same rounding as nn.pred, so the verdicts match torch exactly
+        return np.round(self.predict_proba(x)).astype(bool)
@@ -0,0 +1,156 @@
+import argparse
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import metrics
+from common import CHECK_TIMEOUT, DATA_DIR, Caterpillar, ClickQueue, Color, Snapshot, TestScreen, left_filled
+from npnn import NumpyNN
+from verdicts import SPACE, VerdictTable
+
+AUTO_STAGES = ['wait', 'capture', 'classify', 'infer', 'click']
+AUTO_REPORT_EVERY = 25
+
+
+def load_classifier(name: str) -> Callable[[Caterpillar], bool]:
+    # answer from the compiled verdicts when there are some, the model is only needed for anything else
+    table = VerdictTable.load_current(name)
+    np_net = NumpyNN.load_current(name)
+    has_torch = os.path.exists(os.path.join(DATA_DIR, f'{name}.torch'))
+    if table is None and np_net is None:
+        # those load in milliseconds and answer faster than a round trip, only the torch model is worth asking for
+        import serve
+        if serve.server_running():
+            client = serve.InferenceClient()
+            if name in client.levels():
+                logging.info(f'Classifying {name} with the inference server')
+                return lambda caterpillar: client.classify(name, [caterpillar])[0]
+            logging.warning(f'The inference server has no model for {name}, loading it here')
+            client.close()
+
+    def torch_net() -> NumpyNN:
+        # only the torch model is left, torch reads it once and the numpy copy answers
+        import nn
+        return NumpyNN.from_net(nn.load_net(name))
+
+    if table is None and np_net is None:
+        np_net = torch_net()
+
+    def classify(caterpillar: Caterpillar) -> bool:
+        nonlocal np_net
+        if table is not None and caterpillar in SPACE:
+            return table.lookup(caterpillar)[0]
+        if np_net is None:
+            if not has_torch:
+                raise KeyError(f'{name} only has compiled verdicts, which do not cover {caterpillar}')
+            # torch is only imported once a read falls outside the compiled verdicts
+            np_net = torch_net()
+        return bool(np_net.pred([caterpillar.json()])[0])
+
+    return classify
+
+
+def test(*, name: str):
+    classify = load_classifier(name)
+    test_screen = TestScreen()
+    test_screen.init()
+
+    while 1:
+        val = input('Press enter to read the caterpillar. (q to quit)').lower()
+        if val == 'q':
+            break
+        with metrics.timer('play.test.read'):
+            caterpillar = test_screen.test_caterpillar()
+        if not len(caterpillar):
+            print('No caterpillar on screen')
+            continue
+        with metrics.timer('play.test.infer'):
+            try:
+                valid = classify(caterpillar)
+            except KeyError as e:
+                print(e)
+                continue
+        if valid:
+            print(f'{caterpillar} is Valid')
+        else:
+            print(f'{caterpillar} is Invalid')
+
+
+def _report_latencies(latencies: Dict[str, List[float]], tests: int, elapsed: float):
+    stages = ' | '.join(f'{stage} {np.percentile(times, 50) * 1000:.1f}/{np.percentile(times, 99) * 1000:.1f}'
+                        for stage, times in latencies.items())
+    print(f'{tests} tests at {tests / elapsed * 60:.0f} per minute | p50/p99 ms: {stages}')
+
+
+def auto_test(*, name: str, count: Optional[int] = None, timeout: float = CHECK_TIMEOUT):
+    classify = load_classifier(name)
+    test_screen = TestScreen()
+    test_screen.init()
+    # the game answers one click at a time, no need to wait between clicks
+    clicks = ClickQueue(0.0)
+
+    latencies: Dict[str, List[float]] = {stage: [] for stage in AUTO_STAGES + ['total']}
+    answered = None
+    tests = 0
+    begin = time.perf_counter()
+    try:
+        while count is None or tests < count:
+            wait_start = time.perf_counter()
+            skip = answered
+            while True:
+                start = time.perf_counter()
+                snapshot = Snapshot(test_screen.caterpillar)
+                captured = time.perf_counter()
+                frame = hash(snapshot.pixels.tobytes())
+                # a caterpillar is new once the region changed since the last answer
+                if frame == skip and captured - wait_start < timeout:
+                    continue
+                caterpillar = test_screen.test_caterpillar(snapshot)
+                classified = time.perf_counter()
+                if caterpillar.combo[0] != Color.Null and left_filled(caterpillar.json()):
+                    if frame == answered:
+                        logging.warning(f'{caterpillar} has not changed in {timeout} s, answering it again.')
+                    break
+                # nothing on screen yet, wait for the next change
+                skip = frame
+
+            valid = classify(caterpillar)
+            inferred = time.perf_counter()
+            clicks.add(test_screen.valid if valid else test_screen.invalid).send()
+            clicked = time.perf_counter()
+            answered = frame
+            tests += 1
+
+            for stage, seconds in zip(AUTO_STAGES, [start - wait_start, captured - start, classified - captured,
+                                                    inferred - classified, clicked - inferred]):
+                latencies[stage].append(seconds)
+                metrics.observe(f'play.auto_test.{stage}', seconds)
+            latencies['total'].append(clicked - start)
+            logging.debug(f'{caterpillar} is {"Valid" if valid else "Invalid"} ({(clicked - start) * 1000:.1f} ms)')
+            if tests % AUTO_REPORT_EVERY == 0:
+                _report_latencies(latencies, tests, time.perf_counter() - begin)
+    except KeyboardInterrupt:
+        pass
+    if tests:
+        _report_latencies(latencies, tests, time.perf_counter() - begin)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--auto', action='store_true', help='test hands-free, clicking each verdict')
+    parser.add_argument('--count', type=int, help='stop --auto after this many tests')
+    args = parser.parse_args()
+
+    if args.auto:
+        auto_test(name=args.name, count=args.count)
+    else:
+        test(name=args.name)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
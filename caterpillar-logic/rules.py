@@ -0,0 +1,205 @@
+import argparse
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from common import MAX_CATERPILLAR_SIZE, Color
+from dataset import load_dataset
+from verdicts import RULE_SOURCE, SPACE, VerdictTable
+
+COLORS = [Color.Red, Color.Green, Color.Blue, Color.Grey]
+
+
+@dataclass
+class Rule:
+    name: str
+    complexity: int
+    fn: Callable[[np.ndarray], np.ndarray]
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __call__(self, segments: np.ndarray) -> np.ndarray:
+        return self.fn(np.asarray(segments))
+
+
+@dataclass
+class RuleFit:
+    rule: Rule
+    correct: int
+    total: int
+
+    @property
+    def coverage(self) -> float:
+        return self.correct / self.total
+
+    @property
+    def consistent(self) -> bool:
+        return self.correct == self.total
+
+
+def _lengths(s: np.ndarray) -> np.ndarray:
+    return (s > 0).sum(axis=1)
+
+
+def _count(s: np.ndarray, color: Color) -> np.ndarray:
+    return (s == color.value).sum(axis=1)
+
+
+def _last(s: np.ndarray) -> np.ndarray:
+    return s[np.arange(len(s)), np.maximum(_lengths(s) - 1, 0)]
+
+
+def _pairs(s: np.ndarray):
+    # adjacent segments, ignoring the Null padding
+    return s[:, :-1], s[:, 1:], (s[:, :-1] > 0) & (s[:, 1:] > 0)
+
+
+def _run_lengths(s: np.ndarray) -> np.ndarray:
+    # length of the run of one color starting at each segment, 0 where no run starts
+    lengths = np.zeros(s.shape, dtype=int)
+    run = np.zeros(len(s), dtype=int)
+    for i in reversed(range(s.shape[1])):
+        continues = s[:, i] == s[:, i + 1] if i + 1 < s.shape[1] else np.zeros(len(s), dtype=bool)
+        run = np.where(s[:, i] > 0, np.where(continues, run + 1, 1), 0)
+        lengths[:, i] = run
+    starts = np.ones(s.shape, dtype=bool)
+    starts[:, 1:] = s[:, 1:] != s[:, :-1]
+    return np.where(starts, lengths, 0)
+
+
+def _neighbours(s: np.ndarray) -> np.ndarray:
+    left, right, filled = _pairs(s)
+    return ((left == right) & filled).sum(axis=1)
+
+
+def _distinct(s: np.ndarray) -> np.ndarray:
+    return sum((_count(s, c) > 0).astype(int) for c in COLORS)
+
+
+def _palindrome(s: np.ndarray) -> np.ndarray:
+    lengths = _lengths(s)
+    result = np.ones(len(s), dtype=bool)
+    for i in range(MAX_CATERPILLAR_SIZE):
+        mirror = np.clip(lengths - 1 - i, 0, MAX_CATERPILLAR_SIZE - 1)
+        result &= (i >= lengths) | (s[:, i] == s[np.arange(len(s)), mirror])
+    return result
+
+
+def candidate_rules() -> List[Rule]:
+    rules = []
+
+    def add(name: str, fn: Callable[[np.ndarray], np.ndarray], complexity: int = 1):
+        rules.append(Rule(name, complexity, fn))
+
+    sizes = range(1, MAX_CATERPILLAR_SIZE + 1)
+    for k in sizes:
+        add(f'length == {k}', lambda s, k=k: _lengths(s) == k)
+        add(f'length >= {k}', lambda s, k=k: _lengths(s) >= k)
+    add('length is even', lambda s: _lengths(s) % 2 == 0)
+    add('length is odd', lambda s: _lengths(s) % 2 == 1)
+
+    for c in COLORS:
+        for k in range(MAX_CATERPILLAR_SIZE + 1):
+            add(f'count({c}) == {k}', lambda s, c=c, k=k: _count(s, c) == k)
+            add(f'count({c}) >= {k}', lambda s, c=c, k=k: _count(s, c) >= k)
+        add(f'count({c}) is even', lambda s, c=c: _count(s, c) % 2 == 0)
+        add(f'count({c}) is odd', lambda s, c=c: _count(s, c) % 2 == 1)
+        add(f'first is {c}', lambda s, c=c: s[:, 0] == c.value)
+        add(f'last is {c}', lambda s, c=c: _last(s) == c.value)
+        add(f'all {c}', lambda s, c=c: _count(s, c) == _lengths(s))
+        for p in range(MAX_CATERPILLAR_SIZE):
+            add(f'segment {p + 1} is {c}', lambda s, c=c, p=p: s[:, p] == c.value, 2)
+        for other in COLORS:
+            if other != c:
+                add(f'count({c}) > count({other})', lambda s, c=c, o=other: _count(s, c) > _count(s, o), 2)
+                add(f'count({c}) == count({other})', lambda s, c=c, o=other: _count(s, c) == _count(s, o), 2)
+            add(f'{c} next to {other}',
+                lambda s, c=c, o=other: ((_pairs(s)[0] == c.value) & (_pairs(s)[1] == o.value)).any(axis=1), 2)
+
+    for k in range(MAX_CATERPILLAR_SIZE):
+        add(f'matching neighbours == {k}', lambda s, k=k: _neighbours(s) == k)
+        add(f'matching neighbours >= {k}', lambda s, k=k: _neighbours(s) >= k)
+    for k in sizes:
+        add(f'runs == {k}', lambda s, k=k: (_run_lengths(s) > 0).sum(axis=1) == k)
+    for n in range(1, 4):
+        for k in range(1, 4):
+            add(f'runs of {n} == {k}', lambda s, n=n, k=k: (_run_lengths(s) == n).sum(axis=1) == k, 2)
+    add('first is last', lambda s: s[:, 0] == _last(s))
+    add('palindrome', _palindrome)
+    for k in range(1, len(COLORS) + 1):
+        add(f'distinct colors == {k}', lambda s, k=k: _distinct(s) == k)
+        add(f'distinct colors >= {k}', lambda s, k=k: _distinct(s) >= k)
+
+    rules += [Rule(f'not ({r})', r.complexity + 1, lambda s, r=r: ~r(s)) for r in list(rules)]
+    return rules
+
+
+def _combine(a: Rule, b: Rule, op: str) -> Rule:
+    if op == 'and':
+        return Rule(f'({a}) and ({b})', a.complexity + b.complexity + 1, lambda s: a(s) & b(s))
+    return Rule(f'({a}) or ({b})', a.complexity + b.complexity + 1, lambda s: a(s) | b(s))
+
+
+def fit_rule(segments: np.ndarray, labels: np.ndarray, rules: Optional[List[Rule]] = None) -> RuleFit:
+    if rules is None:
+        rules = candidate_rules()
+    labels = np.asarray(labels, dtype=bool)
+    # one row per rule, evaluated over every labeled caterpillar at once
+    matrix = np.stack([r(segments) for r in rules])
+    complexity = np.array([r.complexity for r in rules])
+    correct = (matrix == labels).sum(axis=1)
+
+    # prefer the simplest single rule that explains everything
+    consistent = np.flatnonzero(correct == len(labels))
+    if len(consistent):
+        best = consistent[np.argmin(complexity[consistent])]
+        return RuleFit(rules[best], int(correct[best]), len(labels))
+
+    # otherwise search pairs, rows are the first rule and columns the second
+    best_fit = None
+    for op, combined in [('and', lambda a, b: a & b), ('or', lambda a, b: a | b)]:
+        for i in range(len(rules)):
+            pair_correct = (combined(matrix[i], matrix[i + 1:]) == labels).sum(axis=1)
+            for j in np.flatnonzero(pair_correct == len(labels)) + i + 1:
+                cost = complexity[i] + complexity[j] + 1
+                if best_fit is None or cost < best_fit.rule.complexity:
+                    best_fit = RuleFit(_combine(rules[i], rules[j], op), len(labels), len(labels))
+    if best_fit is not None:
+        return best_fit
+
+    # nothing is consistent, fall back to the single rule that explains the most
+    best = max(range(len(rules)), key=lambda i: (correct[i], -complexity[i]))
+    return RuleFit(rules[best], int(correct[best]), len(labels))
+
+
+def compile_rule(name: str, rule: Rule):
+    verdicts = rule(SPACE.unrank_array(np.arange(len(SPACE))))
+    VerdictTable(verdicts, np.ones(len(verdicts)), RULE_SOURCE).save(name)
+    logging.info(f'Compiled {len(verdicts)} verdicts for {name}, {verdicts.mean():.1%} valid.')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--compile', action='store_true', help='write the verdict table from a consistent rule')
+    args = parser.parse_args()
+
+    data = load_dataset(args.name)
+    start = time.perf_counter()
+    fit = fit_rule(data.segments, data.labels)
+    elapsed = time.perf_counter() - start
+    print(f'{args.name}: {fit.rule} explains {fit.correct} of {fit.total} ({fit.coverage:.1%}) '
+          f'in {elapsed * 1000:.1f} ms')
+    if args.compile:
+        if not fit.consistent:
+            raise AssertionError(f'{fit.rule} is not consistent with {args.name}, not compiling')
+        compile_rule(args.name, fit.rule)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,271 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import metrics
+from common import COLOR_BASE, DATA_DIR, MAX_CATERPILLAR_SIZE, Caterpillar, caterpillars_to_array
+from npnn import NumpyNN
+from verdicts import SPACE, VerdictTable
+
+SOCKET_PATH = os.path.join(DATA_DIR, 'serve.sock')
+RELOAD_INTERVAL = 1.0
+CONNECT_TIMEOUT = 0.5
+# compiled verdicts, exported numpy weights and the torch model, in the order they are preferred
+MODEL_SUFFIXES = ['.verdicts.npz', '.weights.npz', '.torch']
+
+
+def level_names() -> List[str]:
+    names = set()
+    for suffix in MODEL_SUFFIXES:
+        names.update(os.path.basename(p)[:-len(suffix)] for p in glob.glob(os.path.join(DATA_DIR, f'*{suffix}')))
+    return sorted(names)
+
+
+def model_mtimes(name: str) -> Tuple[float, ...]:
+    paths = [os.path.join(DATA_DIR, f'{name}{suffix}') for suffix in MODEL_SUFFIXES]
+    return tuple(os.path.getmtime(p) if os.path.exists(p) else 0.0 for p in paths)
+
+
+class LevelModel:
+    def __init__(self, name: str):
+        self.name = name
+        # read before loading, so a file written during the load is picked up by the next reload
+        self.mtimes = model_mtimes(name)
+        # compiled verdicts and exported weights are skipped once the torch model was retrained past them
+        self.table = VerdictTable.load_current(name)
+        self.net = NumpyNN.load_current(name)
+        if self.net is None and os.path.exists(os.path.join(DATA_DIR, f'{name}.torch')):
+            # torch is only needed to read the weights, inference runs on the numpy copy
+            import nn
+            self.net = NumpyNN.from_net(nn.load_net(name))
+
+    def classify(self, segments: np.ndarray) -> np.ndarray:
+        verdicts = np.zeros(len(segments), dtype=bool)
+        known = np.zeros(len(segments), dtype=bool)
+        if self.table is not None:
+            ranks = SPACE.rank_array(segments)
+            known = ranks >= 0
+            verdicts[known] = self.table.lookup_ranks(ranks[known])[0]
+        if not known.all():
+            if self.net is None:
+                raise KeyError(f'{self.name} only has compiled verdicts, which do not cover every caterpillar')
+            verdicts[~known] = self.net.pred(segments[~known])
+        return verdicts
+
+
+class ModelStore:
+    def __init__(self):
+        self.models: Dict[str, LevelModel] = {}
+        # the model_mtimes of levels that failed to load, they are only retried once those change
+        self.failed: Dict[str, Tuple[float, ...]] = {}
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def reload(self):
+        models = {}
+        failed = {}
+        for name in level_names():
+            model = self.models.get(name)
+            mtimes = model_mtimes(name)
+            if self.failed.get(name) == mtimes:
+                # nothing changed since the last attempt failed, it would only fail again
+                failed[name] = mtimes
+            elif model is None or model.mtimes != mtimes:
+                start = time.perf_counter()
+                try:
+                    model = LevelModel(name)
+                except Exception as e:
+                    # a file still being written, keep serving the old model and try again once it changes
+                    logging.warning(f'Could not load {name}: {e}')
+                    failed[name] = mtimes
+                else:
+                    logging.info(f'Loaded {name} in {(time.perf_counter() - start) * 1000:.1f} ms')
+            if model is not None:
+                models[name] = model
+        for name in self.models.keys() - models.keys():
+            logging.info(f'Dropped {name}, its files are gone')
+        # swapped in one assignment, requests never see a half-reloaded store
+        self.models = models
+        self.failed = failed
+
+    def _watch(self):
+        while not self.stopped.wait(RELOAD_INTERVAL):
+            self.reload()
+
+    def start(self) -> 'ModelStore':
+        self.reload()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._watch, name='reload', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def handle(self, request: Dict) -> Dict:
+        op = request.get('op', 'classify')
+        if op == 'levels':
+            return {'levels': sorted(self.models)}
+        if op != 'classify':
+            raise ValueError(f'Unknown op {op}')
+        model = self.models.get(request['name'])
+        if model is None:
+            raise KeyError(f'No model for level {request["name"]}')
+        segments = np.asarray(request['caterpillars'], dtype=np.int64).reshape(-1, MAX_CATERPILLAR_SIZE)
+        # an out of range value would rank as some other caterpillar and get its verdict
+        if segments.size and (segments.min() < 0 or segments.max() >= COLOR_BASE):
+            raise ValueError(f'Segment values must be 0 to {COLOR_BASE - 1}')
+        segments = segments.astype(np.uint8)
+        with metrics.timer('serve.classify'):
+            return {'verdicts': model.classify(segments).tolist()}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: '_Server'
+
+    def handle(self):
+        # one connection stays open for any number of newline separated requests
+        for line in self.rfile:
+            try:
+                response = self.server.store.handle(json.loads(line))
+            except Exception as e:
+                response = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, store: ModelStore):
+        self.store = store
+        super().__init__(path, _Handler)
+
+
+def serve(path: str = SOCKET_PATH):
+    if os.path.exists(path):
+        if server_running(path):
+            raise RuntimeError(f'An inference server is already listening on {path}')
+        # left behind by a server that did not shut down cleanly
+        os.remove(path)
+    # stop the same way on kill as on ctrl-c, so the socket is removed either way
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    store = ModelStore().start()
+    logging.info(f'Serving {", ".join(sorted(store.models)) or "no levels"} on {path}')
+    try:
+        with _Server(path, store) as server:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.stop()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class InferenceClient:
+    def __init__(self, path: str = SOCKET_PATH, timeout: Optional[float] = None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self) -> 'InferenceClient':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def request(self, request: Dict) -> Dict:
+        with self.lock:
+            self.sock.sendall(json.dumps(request).encode() + b'\n')
+            line = self.file.readline()
+        if not line:
+            raise RuntimeError('The inference server closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(f'Inference server: {response["error"]}')
+        return response
+
+    def levels(self) -> List[str]:
+        return self.request({'op': 'levels'})['levels']
+
+    def classify_array(self, name: str, segments: np.ndarray) -> np.ndarray:
+        response = self.request({'name': name, 'caterpillars': np.asarray(segments).tolist()})
+        return np.array(response['verdicts'], dtype=bool)
+
+    def classify(self, name: str, caterpillars: Sequence[Caterpillar]) -> List[bool]:
+        return self.classify_array(name, caterpillars_to_array(caterpillars)).tolist()
+
+
+def server_running(path: str = SOCKET_PATH) -> bool:
+    if not os.path.exists(path):
+        return False
+    try:
+        with InferenceClient(path, timeout=CONNECT_TIMEOUT):
+            return True
+    except OSError:
+        return False
+
+
+def bench_client(name: str, path: str = SOCKET_PATH, batch: int = 1, count: int = 1000):
+    rng = np.random.default_rng(0)
+    segments = SPACE.unrank_array(rng.integers(0, len(SPACE), batch))
+    with InferenceClient(path) as client:
+        client.classify_array(name, segments)
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            client.classify_array(name, segments)
+            latencies.append(time.perf_counter() - start)
+    print(f'{name} batch {batch}: p50 {np.percentile(latencies, 50) * 1000:.3f} ms, '
+          f'p99 {np.percentile(latencies, 99) * 1000:.3f} ms over {count} requests')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['serve', 'levels', 'classify', 'bench'])
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--name', help='the level to classify with')
+    parser.add_argument('--batch', type=int, default=1, help='caterpillars per request for bench')
+    parser.add_argument('caterpillars', nargs='*', help='caterpillars to classify, e.g. 1230000 for red,green,blue')
+    # intermixed so the caterpillars can come after --name
+    args = parser.parse_intermixed_args()
+    if args.mode in ('classify', 'bench') and args.name is None:
+        parser.error(f'{args.mode} needs --name')
+
+    if args.mode == 'serve':
+        serve(args.socket)
+    elif args.mode == 'levels':
+        with InferenceClient(args.socket) as client:
+            print('\n'.join(client.levels()))
+    elif args.mode == 'classify':
+        caterpillars = [Caterpillar.from_json([int(v) for v in c.ljust(MAX_CATERPILLAR_SIZE, '0')])
+                        for c in args.caterpillars]
+        with InferenceClient(args.socket) as client:
+            for caterpillar, valid in zip(caterpillars, client.classify(args.name, caterpillars)):
+                print(f'{caterpillar} is {"Valid" if valid else "Invalid"}')
+    else:
+        bench_client(args.name, args.socket, args.batch)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,358 @@
+import argparse
+import contextlib
+import logging
+import math
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from backend import Backend, BBox, set_backend
+from common import (DATA_DIR, DEFAULT_CATERPILLAR_SIZE, MAX_CATERPILLAR_SIZE, NUM_DEFAULT_CATERPILLARS, Caterpillar,
+                    Color, InputScreen, load_results)
+from journal import Journal
+from space import CaterpillarSpace
+
+Rule = Callable[[Caterpillar], bool]
+
+# simulated datasets are named sim/<rule>, a data subdirectory the level globs do not look into
+SIM_DIR = 'sim'
+
+WIDTH, HEIGHT = 800, 600
+PALETTE = {
+    Color.Red: (230, 60, 60),
+    Color.Green: (70, 200, 90),
+    Color.Blue: (60, 110, 230),
+    Color.Grey: (150, 150, 150),
+}
+DELETE_COLOR = (240, 240, 240)
+OK_COLOR = (250, 200, 40)
+NAV_COLOR = (200, 120, 250)
+
+BUTTON_RADIUS = 20
+BUTTON_Y = 550
+BUTTONS = {
+    Color.Red: (150, BUTTON_Y),
+    Color.Green: (250, BUTTON_Y),
+    Color.Blue: (350, BUTTON_Y),
+    Color.Grey: (450, BUTTON_Y),
+    'delete': (550, BUTTON_Y),
+    'ok': (650, BUTTON_Y),
+}
+BACK = (40, 30)
+LEVEL = (400, 300)
+
+SEGMENT_RADIUS = 8
+SEGMENT_SPACING = 25
+VALID_X = 60
+INVALID_X = 460
+ROW_Y = 80
+ROW_SPACING = 60
+TEST_X = 250
+TEST_Y = 300
+READY_Y = 420
+
+
+def rule_by_name(name: str) -> Rule:
+    from rules import candidate_rules
+
+    for rule in candidate_rules():
+        if str(rule) == name:
+            return lambda c: bool(rule(np.array([c.json()]))[0])
+    raise KeyError(f'No rule named {name}')
+
+
+def rule_from_data(name: str) -> Rule:
+    from rules import fit_rule
+
+    results = load_results(os.path.join(DATA_DIR, f'{name}.json'))
+    segments = np.array([c.json() for c in results])
+    fit = fit_rule(segments, np.array(list(results.values())))
+    logging.info(f'Answering unlabeled caterpillars for {name} with {fit.rule} ({fit.coverage:.1%} of the data)')
+    return lambda c: results[c] if c in results else bool(fit.rule(np.array([c.json()]))[0])
+
+
+class SimulatedGame(Backend):
+    def __init__(self, rule: Rule, *, input_latency: float = 0.0, verdict_latency: float = 0.0,
+                 nav_latency: float = 0.0, grab_latency: float = 0.0, seed: Optional[int] = None, test: bool = False):
+        self.rule = rule
+        self.input_latency = input_latency
+        self.verdict_latency = verdict_latency
+        self.nav_latency = nav_latency
+        self.grab_latency = grab_latency
+        self.rng = random.Random(seed)
+        self.space = CaterpillarSpace(DEFAULT_CATERPILLAR_SIZE)
+        self.test_space = CaterpillarSpace()
+
+        self.screen = 'levels'
+        self.entry: List[Color] = []
+        self.valid_rows: List[Caterpillar] = []
+        self.invalid_rows: List[Caterpillar] = []
+        self.test_caterpillar: Optional[Caterpillar] = None
+        self.pending: List[Tuple[float, Callable[[], None]]] = []
+        self.position: Tuple[int, int] = (0, 0)
+        self.last_click = -math.inf
+        self.frame: Optional[Image.Image] = None
+        # a capture thread may grab while the main thread clicks
+        self.lock = threading.RLock()
+
+        self.clicks = 0
+        self.dropped_clicks = 0
+        self.verdicts = 0
+        self.levels_opened = 0
+        self.tests = 0
+        self.correct = 0
+        if test:
+            self._next_test()
+        else:
+            # curating starts from an open level, like it does in front of the real game
+            self._open_level()
+
+    def settings(self, screen: str) -> Optional[Dict]:
+        if screen == 'test':
+            return {
+                'caterpillar': [(TEST_X + i * SEGMENT_SPACING, TEST_Y) for i in range(MAX_CATERPILLAR_SIZE)],
+                'valid': (TEST_X, READY_Y),
+                'invalid': (TEST_X + (MAX_CATERPILLAR_SIZE - 1) * SEGMENT_SPACING, READY_Y),
+            }
+        if screen != 'input':
+            return None
+        return {
+            'red': BUTTONS[Color.Red],
+            'green': BUTTONS[Color.Green],
+            'blue': BUTTONS[Color.Blue],
+            'grey': BUTTONS[Color.Grey],
+            'backspace': BUTTONS['delete'],
+            'ok': BUTTONS['ok'],
+            'click_delay': self.input_latency,
+            'offsets': [(0, r * ROW_SPACING) for r in range(NUM_DEFAULT_CATERPILLARS)],
+            'valid': [(VALID_X + i * SEGMENT_SPACING, ROW_Y) for i in range(MAX_CATERPILLAR_SIZE)],
+            'invalid': [(INVALID_X + i * SEGMENT_SPACING, ROW_Y) for i in range(MAX_CATERPILLAR_SIZE)],
+            'back': BACK,
+            'level': LEVEL,
+        }
+
+    def grab(self, bbox: Optional[BBox] = None) -> Image.Image:
+        if self.grab_latency:
+            # a real grab waits on the display server, the frame is as of the end of that wait
+            time.sleep(self.grab_latency)
+        with self.lock:
+            self._advance()
+            if self.frame is None:
+                self.frame = self._render()
+            return self.frame.crop(bbox) if bbox else self.frame.copy()
+
+    def move(self, xy: Tuple[int, int]):
+        self.position = xy
+
+    def press(self):
+        pass
+
+    def release(self):
+        with self.lock:
+            self._advance()
+            self._on_click(self.position)
+
+    def wait_for_click(self) -> Tuple[int, int]:
+        raise RuntimeError('Nobody can click on the simulator, it provides its own layout')
+
+    def _schedule(self, delay: float, event: Callable[[], None]):
+        if delay <= 0:
+            event()
+            self.frame = None
+        else:
+            self.pending.append((time.perf_counter() + delay, event))
+
+    def _advance(self):
+        now = time.perf_counter()
+        due = [p for p in self.pending if p[0] <= now]
+        if due:
+            self.pending = [p for p in self.pending if p[0] > now]
+            for _, event in sorted(due, key=lambda p: p[0]):
+                event()
+            self.frame = None
+
+    def _hit(self, xy: Tuple[int, int]):
+        targets = dict(BUTTONS)
+        if self.screen == 'test':
+            test = self.settings('test')
+            targets.update({'valid': test['valid'], 'invalid': test['invalid']})
+        else:
+            targets['back'] = BACK
+            targets['level'] = LEVEL
+        for name, center in targets.items():
+            if (xy[0] - center[0]) ** 2 + (xy[1] - center[1]) ** 2 <= BUTTON_RADIUS ** 2:
+                return name
+        return None
+
+    def _on_click(self, xy: Tuple[int, int]):
+        now = time.perf_counter()
+        self.clicks += 1
+        # like the game, ignore clicks that come in faster than it can register them
+        if now - self.last_click < self.input_latency:
+            self.dropped_clicks += 1
+            return
+        self.last_click = now
+
+        target = self._hit(xy)
+        if self.screen == 'test':
+            if target in ('valid', 'invalid') and self.test_caterpillar is not None:
+                self.tests += 1
+                self.correct += (target == 'valid') == self.rule(self.test_caterpillar)
+                self.test_caterpillar = None
+                self._schedule(self.verdict_latency, self._next_test)
+            return
+
+        if self.screen == 'levels':
+            if target == 'level':
+                self._schedule(self.nav_latency, self._open_level)
+            return
+
+        if target == 'back':
+            self._schedule(self.nav_latency, self._close_level)
+        elif target in PALETTE and len(self.entry) < MAX_CATERPILLAR_SIZE:
+            self.entry.append(target)
+        elif target == 'delete' and self.entry:
+            self.entry.pop()
+        elif target == 'ok' and self.entry:
+            caterpillar = Caterpillar(tuple(self.entry + [Color.Null] * (MAX_CATERPILLAR_SIZE - len(self.entry))))
+            self.entry = []
+            self._schedule(self.verdict_latency, lambda: self._show(caterpillar, self.rule(caterpillar)))
+
+    def _open_level(self):
+        self.screen = 'level'
+        self.levels_opened += 1
+        self.entry = []
+        self.valid_rows = []
+        self.invalid_rows = []
+        for _ in range(10000):
+            if len(self.valid_rows) >= NUM_DEFAULT_CATERPILLARS and len(self.invalid_rows) >= NUM_DEFAULT_CATERPILLARS:
+                break
+            caterpillar = self.space.unrank(self.rng.randrange(len(self.space)))
+            rows = self.valid_rows if self.rule(caterpillar) else self.invalid_rows
+            if len(rows) < NUM_DEFAULT_CATERPILLARS:
+                rows.append(caterpillar)
+
+    def _next_test(self):
+        self.screen = 'test'
+        self.test_caterpillar = self.test_space.unrank(self.rng.randrange(len(self.test_space)))
+
+    def _close_level(self):
+        self.screen = 'levels'
+
+    def _show(self, caterpillar: Caterpillar, valid: bool):
+        self.verdicts += 1
+        rows = self.valid_rows if valid else self.invalid_rows
+        rows.insert(0, caterpillar)
+        del rows[NUM_DEFAULT_CATERPILLARS:]
+
+    def _render(self) -> Image.Image:
+        image = Image.new('RGB', (WIDTH, HEIGHT), (0, 0, 0))
+        draw = ImageDraw.Draw(image)
+
+        def circle(center: Tuple[int, int], radius: int, fill: Tuple[int, int, int]):
+            draw.ellipse((center[0] - radius, center[1] - radius, center[0] + radius, center[1] + radius), fill=fill)
+
+        for target, center in BUTTONS.items():
+            fill = PALETTE.get(target, DELETE_COLOR if target == 'delete' else OK_COLOR)
+            circle(center, BUTTON_RADIUS, fill)
+
+        if self.screen == 'levels':
+            circle(LEVEL, BUTTON_RADIUS, NAV_COLOR)
+            return image
+
+        if self.screen == 'test':
+            test = self.settings('test')
+            circle(test['valid'], BUTTON_RADIUS, NAV_COLOR)
+            circle(test['invalid'], BUTTON_RADIUS, NAV_COLOR)
+            if self.test_caterpillar is not None:
+                for loc, color in zip(test['caterpillar'], self.test_caterpillar.combo):
+                    if color != Color.Null:
+                        circle(loc, SEGMENT_RADIUS, PALETTE[color])
+            return image
+
+        circle(BACK, BUTTON_RADIUS, NAV_COLOR)
+        for x0, rows in [(VALID_X, self.valid_rows), (INVALID_X, self.invalid_rows)]:
+            for r, caterpillar in enumerate(rows):
+                for i, color in enumerate(caterpillar.combo):
+                    if color != Color.Null:
+                        circle((x0 + i * SEGMENT_SPACING, ROW_Y + r * ROW_SPACING), SEGMENT_RADIUS, PALETTE[color])
+        return image
+
+
+def install(rule: Rule, **kwargs) -> SimulatedGame:
+    game = SimulatedGame(rule, **kwargs)
+    set_backend(game)
+    return game
+
+
+def main():
+    import curate
+
+    parser = argparse.ArgumentParser()
+    rule_group = parser.add_mutually_exclusive_group(required=True)
+    rule_group.add_argument('--rule', help='name of a rule from rules.py, e.g. "palindrome"')
+    rule_group.add_argument('--data', help='answer from data/<name>.json')
+    parser.add_argument('--mode', choices=['check', 'random', 'refresh', 'active', 'test'], default='check')
+    parser.add_argument('--model', help='model play.auto_test answers the test screen with, defaults to --data')
+    parser.add_argument('--name', help='dataset name to curate into, defaults to sim/<rule>')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--thresh', type=float, default=curate.DEFAULT_THRESH)
+    parser.add_argument('--input-latency', type=float, default=0.0)
+    parser.add_argument('--verdict-latency', type=float, default=0.0)
+    parser.add_argument('--nav-latency', type=float, default=0.0)
+    parser.add_argument('--grab-latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--calibrate', action='store_true', help='calibrate the click delay before curating')
+    parser.add_argument('--capture-rate', type=float, help='read check mode through a capture thread at this rate')
+    args = parser.parse_args()
+    if args.mode == 'test' and not (args.model or args.data):
+        parser.error('test mode needs --model or --data to know which model to test')
+
+    rule = rule_by_name(args.rule) if args.rule else rule_from_data(args.data)
+    game = install(rule, input_latency=args.input_latency, verdict_latency=args.verdict_latency,
+                   nav_latency=args.nav_latency, grab_latency=args.grab_latency, seed=args.seed,
+                   test=args.mode == 'test')
+    if args.mode == 'test':
+        import play
+
+        play.auto_test(name=args.model or args.data, count=args.queries)
+        print(f'test: {game.correct} of {game.tests} answered correctly')
+        return
+    name = args.name or os.path.join(SIM_DIR, (args.rule or args.data).replace(' ', '_'))
+
+    def journaled() -> int:
+        with Journal(name) as journal:
+            return len(journal)
+
+    before = journaled()
+    start = time.perf_counter()
+    if args.mode == 'check':
+        game_screen = InputScreen()
+        game_screen.init(calibrate=args.calibrate)
+        game_screen.open_level()
+        space = CaterpillarSpace()
+        with game_screen.capturing(args.capture_rate) if args.capture_rate is not None else contextlib.nullcontext():
+            for _ in range(args.queries):
+                game_screen.check_caterpillar(space.unrank(random.randrange(len(space))))
+        count = args.queries
+    elif args.mode == 'active':
+        curate.curate_active(name=name, calibrate=args.calibrate)
+        count = journaled() - before
+    else:
+        curate_fn = curate.curate_randomly if args.mode == 'random' else curate.curate_refresh
+        curate_fn(name=name, thresh=args.thresh, calibrate=args.calibrate)
+        count = journaled() - before
+    elapsed = time.perf_counter() - start
+    print(f'{args.mode}: {count} caterpillars from {game.verdicts} verdicts, {game.levels_opened} levels and '
+          f'{game.clicks} clicks ({game.dropped_clicks} dropped) in {elapsed:.2f} s, '
+          f'{count / elapsed * 60:.0f} caterpillars per minute')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,87 @@
+from typing import Dict, Iterator, Optional
+
+import numpy as np
+
+from common import MAX_CATERPILLAR_SIZE, Caterpillar
+
+# every segment of a caterpillar is one of these, Null only pads the end
+NUM_COLORS = 4
+BATCH_SIZE = 4096
+
+
+class CaterpillarSpace:
+    def __init__(self, max_size: int = MAX_CATERPILLAR_SIZE):
+        self.max_size = max_size
+        self.sizes: Dict[int, int] = {length: NUM_COLORS ** length for length in range(1, max_size + 1)}
+        # ranks are ordered by length, then in the same order as itertools.product over the colors
+        self.starts = np.cumsum([0] + list(self.sizes.values()))[:-1]
+        self.ends = self.starts + np.array(list(self.sizes.values()))
+
+    def __len__(self):
+        return int(self.ends[-1])
+
+    def __contains__(self, caterpillar: Caterpillar) -> bool:
+        return self.rank(caterpillar) is not None
+
+    def length_range(self, length: int) -> range:
+        return range(int(self.starts[length - 1]), int(self.ends[length - 1]))
+
+    def rank(self, caterpillar: Caterpillar) -> Optional[int]:
+        values = caterpillar.json()
+        length = len(caterpillar)
+        if length == 0 or length > self.max_size or any(v == 0 for v in values[:length]):
+            return None
+        local = 0
+        for value in values[:length]:
+            local = local * NUM_COLORS + value - 1
+        return int(self.starts[length - 1]) + local
+
+    def rank_array(self, segments: np.ndarray) -> np.ndarray:
+        # -1 for anything rank would return None for
+        segments = np.asarray(segments, dtype=np.int64)
+        filled = segments[:, :self.max_size] > 0
+        lengths = filled.sum(axis=1)
+        # left-filled when the filled segments are exactly the first length ones
+        valid = (lengths > 0) & (np.cumprod(filled, axis=1).sum(axis=1) == lengths) \
+            & ~(segments[:, self.max_size:] > 0).any(axis=1)
+        places = np.maximum(lengths[:, np.newaxis] - 1 - np.arange(self.max_size), 0)
+        local = (np.where(filled, segments[:, :self.max_size] - 1, 0) * NUM_COLORS ** places).sum(axis=1)
+        starts = self.starts[np.maximum(lengths, 1) - 1]
+        return np.where(valid, starts + local, -1)
+
+    def unrank(self, rank: int) -> Caterpillar:
+        return Caterpillar.from_codes(self.unrank_array([rank])[0])
+
+    def unrank_array(self, ranks: np.ndarray) -> np.ndarray:
+        ranks = np.asarray(ranks, dtype=np.int64)
+        if ranks.size and (ranks.min() < 0 or ranks.max() >= len(self)):
+            raise IndexError('Caterpillar rank out of range')
+        lengths = np.searchsorted(self.ends, ranks, side='right') + 1
+        local = ranks - self.starts[lengths - 1]
+        segments = np.zeros((len(ranks), MAX_CATERPILLAR_SIZE), dtype=np.uint8)
+        for position in range(self.max_size):
+            # the first segment is the most significant digit
+            place = lengths - 1 - position
+            filled = place >= 0
+            digit = local // NUM_COLORS ** np.maximum(place, 0) % NUM_COLORS + 1
+            segments[:, position] = np.where(filled, digit, 0)
+        return segments
+
+    def sample(self, length: int, k: int, rng: np.random.Generator) -> np.ndarray:
+        size = self.sizes[length]
+        # choice without replacement does not materialize the population
+        return int(self.starts[length - 1]) + rng.choice(size, size=min(k, size), replace=False)
+
+    def stratified_sample(self, thresh: float, min_per_length: int = 0,
+                          rng: Optional[np.random.Generator] = None) -> Dict[int, np.ndarray]:
+        if rng is None:
+            rng = np.random.default_rng()
+        plan = {}
+        for length, size in self.sizes.items():
+            k = max(int(rng.binomial(size, thresh)), min(min_per_length, size))
+            plan[length] = self.sample(length, k, rng)
+        return plan
+
+    def batches(self, ranks: np.ndarray, batch_size: int = BATCH_SIZE) -> Iterator[np.ndarray]:
+        for start in range(0, len(ranks), batch_size):
+            yield self.unrank_array(ranks[start:start + batch_size])
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# the modules are flat scripts that import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+def pytest_configure(config):
+    # every test is tagged with the backlog request whose behavior it covers
+    config.addinivalue_line('markers', 'request(request_id): the backlog request the test covers')
@@ -0,0 +1,49 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from common import (MAX_CATERPILLAR_SIZE, NUM_CODES, Caterpillar, Color, caterpillars_from_array,
+                    caterpillars_to_array, pack_codes, unpack_codes)
+
+pytestmark = pytest.mark.request('user-005')
+
+
+def test_pack_unpack_round_trip():
+    codes = np.random.default_rng(0).integers(0, NUM_CODES, 1000)
+    np.testing.assert_array_equal(pack_codes(unpack_codes(codes)), codes)
+
+
+def test_first_segment_is_least_significant():
+    assert pack_codes([1] + [0] * (MAX_CATERPILLAR_SIZE - 1)) == 1
+    assert Caterpillar.from_json([0, 1] + [0] * (MAX_CATERPILLAR_SIZE - 2)).code == len(Color)
+
+
+def test_json_round_trip():
+    values = [1, 2, 3, 4, 0, 0, 0]
+    caterpillar = Caterpillar.from_json(values)
+    assert caterpillar.json() == values
+    assert caterpillar.combo == (Color.Red, Color.Green, Color.Blue, Color.Grey, Color.Null, Color.Null, Color.Null)
+    assert len(caterpillar) == 4
+
+
+def test_interned():
+    values = [4, 3, 2, 1, 0, 0, 0]
+    caterpillar = Caterpillar.from_json(values)
+    assert Caterpillar(caterpillar.combo) is caterpillar
+    assert Caterpillar.from_code(caterpillar.code) is caterpillar
+    assert pickle.loads(pickle.dumps(caterpillar)) is caterpillar
+
+
+def test_array_round_trip():
+    segments = unpack_codes(np.random.default_rng(1).integers(0, NUM_CODES, 100))
+    caterpillars = caterpillars_from_array(segments)
+    np.testing.assert_array_equal(caterpillars_to_array(caterpillars), segments)
+
+
+@pytest.mark.parametrize('values', [[5, 0, 0, 0, 0, 0, 0], [9, 0, 0, 0, 0, 0, 0], [1, -1, 0, 0, 0, 0, 0]])
+def test_out_of_range_segments_are_rejected(values):
+    with pytest.raises(AssertionError):
+        Caterpillar.from_json(values)
+    with pytest.raises(AssertionError):
+        caterpillars_from_array(np.array([values]))
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from common import MAX_CATERPILLAR_SIZE
+from dataset import PackedDataset, write_dataset
+
+pytestmark = pytest.mark.request('user-009')
+
+
+def test_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    # an odd count, so the last byte of labels is only partly used
+    segments = rng.integers(0, 5, (13, MAX_CATERPILLAR_SIZE)).astype(np.uint8)
+    labels = rng.random(13) < 0.5
+    path = str(tmp_path / 'level.catd')
+    write_dataset(path, segments, labels, {'name': 'level'})
+
+    data = PackedDataset(path)
+    assert len(data) == 13
+    assert data.meta == {'name': 'level'}
+    np.testing.assert_array_equal(data.segments, segments)
+    np.testing.assert_array_equal(data.labels, labels)
+    np.testing.assert_array_equal(data.lengths, (segments > 0).sum(axis=1))
+
+
+def test_empty(tmp_path):
+    path = str(tmp_path / 'empty.catd')
+    write_dataset(path, np.zeros((0, MAX_CATERPILLAR_SIZE)), np.zeros(0, dtype=bool))
+    data = PackedDataset(path)
+    assert len(data) == 0
+    assert data.labels.shape == (0,)
+
+
+def test_split_keeps_short_caterpillars_for_training(tmp_path):
+    segments = np.zeros((200, MAX_CATERPILLAR_SIZE), dtype=np.uint8)
+    segments[:100, :2] = 1
+    segments[100:, :5] = 2
+    path = str(tmp_path / 'split.catd')
+    write_dataset(path, segments, np.ones(200, dtype=bool))
+
+    train, valid = PackedDataset(path).split(0.5, np.random.default_rng(0))
+    assert set(range(100)) <= set(train.tolist())
+    assert set(train.tolist()) | set(valid.tolist()) == set(range(200))
+    assert len(valid) > 0
@@ -0,0 +1,53 @@
+import pytest
+
+import journal
+from common import Caterpillar
+
+pytestmark = pytest.mark.request('user-008')
+
+FIRST = Caterpillar.from_json([1, 2, 0, 0, 0, 0, 0])
+SECOND = Caterpillar.from_json([3, 3, 3, 0, 0, 0, 0])
+THIRD = Caterpillar.from_json([4, 0, 0, 0, 0, 0, 0])
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'DATA_DIR', str(tmp_path))
+    return tmp_path
+
+
+def test_replay():
+    with journal.Journal('level') as j:
+        j.set_meta('seed', 7)
+        assert j.record(FIRST, True)
+        assert j.record(SECOND, False)
+        assert not j.record(FIRST, False)
+
+    with journal.Journal('level') as j:
+        assert j.meta == {'seed': 7}
+        assert j.results() == {FIRST: True, SECOND: False}
+
+
+def test_replay_truncated_last_line(data_dir):
+    with journal.Journal('level') as j:
+        j.record(FIRST, True)
+        j.record(SECOND, False)
+    path = data_dir / 'level.journal'
+    # a crash part way through writing a record
+    text = path.read_text()
+    path.write_text(text + text.splitlines()[-1][:5])
+
+    with journal.Journal('level') as j:
+        assert j.results() == {FIRST: True, SECOND: False}
+        j.record(THIRD, True)
+
+    # the record after the cut is on its own line and survives the next replay
+    with journal.Journal('level') as j:
+        assert j.results() == {FIRST: True, SECOND: False, THIRD: True}
+
+
+def test_dump(data_dir):
+    with journal.Journal('level') as j:
+        j.record(FIRST, True)
+        j.dump()
+    assert (data_dir / 'level.json').exists()
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pytest
+
+import common
+import npnn
+import serve
+import verdicts
+from verdicts import RULE_SOURCE, SPACE, VerdictTable
+
+pytestmark = pytest.mark.request('user-025')
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    for module in [common, npnn, serve, verdicts]:
+        monkeypatch.setattr(module, 'DATA_DIR', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def store():
+    # every caterpillar of odd rank is valid
+    VerdictTable(np.arange(len(SPACE)) % 2 == 1, np.ones(len(SPACE)), RULE_SOURCE).save('level')
+    store = serve.ModelStore()
+    store.reload()
+    return store
+
+
+def test_classify(store):
+    segments = SPACE.unrank_array(np.arange(4))
+    assert store.handle({'name': 'level', 'caterpillars': segments.tolist()}) == {'verdicts': [False, True] * 2}
+
+
+@pytest.mark.parametrize('segment', [5, 255, -1])
+def test_out_of_range_segments_are_rejected(store, segment):
+    with pytest.raises(ValueError):
+        store.handle({'name': 'level', 'caterpillars': [[segment] + [0] * 6]})
+
+
+def test_failed_levels_are_retried_once_they_change(data_dir, caplog):
+    path = data_dir / 'broken.weights.npz'
+    path.write_bytes(b'not an npz')
+    store = serve.ModelStore()
+    store.reload()
+    store.reload()
+    assert [r.getMessage().startswith('Could not load broken') for r in caplog.records] == [True]
+    assert 'broken' not in store.models
+
+    path.write_bytes(b'still not an npz, but changed')
+    os.utime(path, (0, 1))
+    store.reload()
+    assert len(caplog.records) == 2
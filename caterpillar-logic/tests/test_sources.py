@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+import common
+import npnn
+import verdicts
+from npnn import LAYERS, NumpyNN
+from verdicts import RULE_SOURCE, SPACE, VerdictTable
+
+SIZES = {'layer_1': (32, 7), 'layer_2': (32, 32), 'layer_3': (64, 32), 'layer_4': (16, 64), 'layer_out': (1, 16)}
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    for module in [common, npnn, verdicts]:
+        monkeypatch.setattr(module, 'DATA_DIR', str(tmp_path))
+    return tmp_path
+
+
+def _train(data_dir, contents: bytes):
+    # only the bytes matter to the fingerprint
+    (data_dir / 'level.torch').write_bytes(contents)
+
+
+def _weights():
+    rng = np.random.default_rng(0)
+    weights = {}
+    for layer in LAYERS:
+        weights[f'{layer}.weight'] = rng.normal(size=SIZES[layer]).astype(np.float32)
+        weights[f'{layer}.bias'] = rng.normal(size=SIZES[layer][0]).astype(np.float32)
+    return weights
+
+
+@pytest.mark.request('user-011')
+def test_verdicts_follow_the_model(data_dir):
+    _train(data_dir, b'first')
+    VerdictTable.from_probabilities(np.full(len(SPACE), 0.9), common.model_fingerprint('level')).save('level')
+    assert VerdictTable.load_current('level') is not None
+
+    _train(data_dir, b'second')
+    assert VerdictTable.load_current('level') is None
+
+
+@pytest.mark.request('user-011')
+def test_rule_verdicts_never_go_stale(data_dir):
+    VerdictTable(np.ones(len(SPACE)), np.ones(len(SPACE)), RULE_SOURCE).save('level')
+    _train(data_dir, b'first')
+    assert VerdictTable.load_current('level') is not None
+
+
+@pytest.mark.request('user-012')
+def test_weights_follow_the_model(data_dir):
+    _train(data_dir, b'first')
+    np.savez(npnn.weights_path('level'), source=np.array(common.model_fingerprint('level')), **_weights())
+    net = NumpyNN.load_current('level')
+    assert net is not None
+    assert net.pred(SPACE.unrank_array(np.arange(10))).shape == (10,)
+
+    _train(data_dir, b'second')
+    assert NumpyNN.load_current('level') is None
+
+
+@pytest.mark.request('user-012')
+def test_weights_without_a_source_are_stale(data_dir):
+    _train(data_dir, b'first')
+    np.savez(npnn.weights_path('level'), **_weights())
+    assert NumpyNN.load_current('level') is None
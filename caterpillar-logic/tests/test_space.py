@@ -0,0 +1,44 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from common import MAX_CATERPILLAR_SIZE, Caterpillar
+from space import NUM_COLORS, CaterpillarSpace
+
+pytestmark = pytest.mark.request('user-006')
+
+SPACE = CaterpillarSpace()
+
+
+def test_size():
+    assert len(SPACE) == sum(NUM_COLORS ** length for length in range(1, MAX_CATERPILLAR_SIZE + 1))
+
+
+def test_rank_unrank_round_trip():
+    ranks = np.arange(len(SPACE))
+    segments = SPACE.unrank_array(ranks)
+    np.testing.assert_array_equal(SPACE.rank_array(segments), ranks)
+    for rank in [0, 3, 4, 100, len(SPACE) - 1]:
+        assert SPACE.rank(SPACE.unrank(rank)) == rank
+
+
+def test_product_order():
+    for length in range(1, 4):
+        expected = [list(combo) + [0] * (MAX_CATERPILLAR_SIZE - length)
+                    for combo in itertools.product(range(1, NUM_COLORS + 1), repeat=length)]
+        np.testing.assert_array_equal(SPACE.unrank_array(SPACE.length_range(length)), expected)
+
+
+def test_rank_outside_the_space():
+    empty = [0] * MAX_CATERPILLAR_SIZE
+    gap = [1, 0, 2] + [0] * (MAX_CATERPILLAR_SIZE - 3)
+    assert SPACE.rank(Caterpillar.from_json(empty)) is None
+    assert SPACE.rank(Caterpillar.from_json(gap)) is None
+    np.testing.assert_array_equal(SPACE.rank_array([empty, gap]), [-1, -1])
+
+
+def test_rank_array_matches_rank():
+    segments = np.random.default_rng(0).integers(0, NUM_COLORS + 1, (2000, MAX_CATERPILLAR_SIZE))
+    expected = [SPACE.rank(Caterpillar.from_codes(row)) for row in segments]
+    np.testing.assert_array_equal(SPACE.rank_array(segments), [-1 if r is None else r for r in expected])
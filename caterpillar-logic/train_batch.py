@@ -0,0 +1,145 @@
+import argparse
+import csv
+import glob
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+
+import numpy as np
+
+from common import DATA_DIR, MAX_CATERPILLAR_SIZE
+from dataset import load_dataset
+
+VALIDATION = 0.1
+SUMMARY_FILE = os.path.join(DATA_DIR, 'train_summary.csv')
+
+
+@dataclass
+class Job:
+    name: str
+    fold: int
+    folds: int
+    learn_rate: float
+    batch_size: int
+    epochs: int
+    seed: int
+    save: bool = False
+
+
+def _init_worker():
+    # one thread per process, otherwise every worker spawns a thread per core and they fight
+    import torch
+    torch.set_num_threads(1)
+    torch.set_num_interop_threads(1)
+    # one tiny fit pays torch's lazy first-call setup here, so the first job's timing does not include it
+    import nn
+    segments = np.zeros((2, MAX_CATERPILLAR_SIZE), dtype=np.uint8)
+    net = nn.fit(segments, np.array([0, 1], dtype=np.float32), epochs=1, verbose=False)[0]
+    nn.predict_proba(net, segments)
+
+
+def run_job(job: Job) -> Dict:
+    import nn
+    import torch
+
+    start = time.perf_counter()
+    data = load_dataset(job.name)
+    segments, labels = np.array(data.segments), data.labels
+    rng = np.random.default_rng(job.seed)
+    if job.folds > 1:
+        # every job of a level shares the seed, so the folds partition the same permutation
+        valid_idx = np.array_split(rng.permutation(len(data)), job.folds)[job.fold]
+        train_idx = np.setdiff1d(np.arange(len(data)), valid_idx)
+    else:
+        train_idx, valid_idx = data.split(VALIDATION, rng)
+
+    net, losses, accuracies = nn.fit(segments[train_idx], labels[train_idx], epochs=job.epochs,
+                                     learn_rate=job.learn_rate, batch_size=job.batch_size, verbose=False)
+    probabilities = nn.predict_proba(net, segments[valid_idx])
+    if job.save:
+        torch.save(net.state_dict(), os.path.join(DATA_DIR, f'{job.name}.torch'))
+
+    result = asdict(job)
+    del result['save']
+    result.update({
+        'train': len(train_idx),
+        'valid': len(valid_idx),
+        'train_acc': accuracies[-1] / 100,
+        'valid_acc': float(((probabilities > 0.5) == labels[valid_idx]).mean()),
+        'seconds': time.perf_counter() - start,
+    })
+    return result
+
+
+def run_jobs(jobs: List[Job], workers: int) -> List[Dict]:
+    # torch and the openmp runtimes read these at import time in the workers
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = '1'
+    # spawn instead of fork so workers never inherit torch thread pools from this process
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+        return list(pool.map(run_job, jobs))
+
+
+def write_summary(results: List[Dict], path: str = SUMMARY_FILE):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f'{"name":>6} {"fold":>5} {"lr":>8} {"batch":>6} {"train":>6} {"valid":>6} {"seconds":>8}')
+    for r in results:
+        print(f'{r["name"]:>6} {r["fold"] + 1:>2}/{r["folds"]:<2} {r["learn_rate"]:>8} {r["batch_size"]:>6} '
+              f'{r["train_acc"]:>6.3f} {r["valid_acc"]:>6.3f} {r["seconds"]:>8.2f}')
+    logging.info(f'Wrote {len(results)} runs to {path}')
+
+
+def main():
+    import nn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--names', nargs='+', help='levels to train, defaults to every json dataset')
+    parser.add_argument('--folds', type=int, default=1)
+    parser.add_argument('--learn-rates', type=float, nargs='+', default=[nn.LEARN_RATE])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[nn.BATCH_SIZE])
+    parser.add_argument('--epochs', type=int, default=nn.EPOCHS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', action='store_true', help='save each level\'s model, needs a single run per level')
+    args = parser.parse_args()
+
+    names = args.names or [os.path.basename(p)[:-len('.json')]
+                           for p in sorted(glob.glob(os.path.join(DATA_DIR, '*.json')))]
+    # an empty job list would fail later in the pool and the summary with far less helpful errors
+    if not names:
+        parser.error(f'Nothing to train, there are no json datasets in {DATA_DIR}')
+    if args.folds < 1 or args.workers < 1:
+        parser.error('--folds and --workers must be at least 1')
+    grid = list(itertools.product(args.learn_rates, args.batch_sizes))
+    if args.save and (args.folds > 1 or len(grid) > 1):
+        parser.error('--save needs a single fold and a single learn rate and batch size')
+
+    # convert up front so the workers do not race to write the same packed dataset
+    for name in names:
+        load_dataset(name)
+
+    jobs = [
+        Job(name, fold, args.folds, learn_rate, batch_size, args.epochs, args.seed, args.save)
+        for name in names
+        for fold in range(args.folds)
+        for learn_rate, batch_size in grid
+    ]
+    start = time.perf_counter()
+    results = run_jobs(jobs, min(args.workers, len(jobs)))
+    logging.info(f'Ran {len(jobs)} jobs on {args.workers} workers in {time.perf_counter() - start:.1f} s')
+    write_summary(results)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,66 @@
+import logging
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from common import DATA_DIR, Caterpillar, model_fingerprint
+from space import CaterpillarSpace
+
+SPACE = CaterpillarSpace()
+# the source of a table compiled from a rule, it does not depend on any model
+RULE_SOURCE = 'rule'
+
+
+def verdicts_path(name: str) -> str:
+    return os.path.join(DATA_DIR, f'{name}.verdicts.npz')
+
+
+class VerdictTable:
+    def __init__(self, verdicts: np.ndarray, confidence: np.ndarray, source: str = ''):
+        assert len(verdicts) == len(confidence) == len(SPACE)
+        self.verdicts = np.asarray(verdicts, dtype=bool)
+        self.confidence = np.asarray(confidence, dtype=np.float16)
+        # the model_fingerprint of the model the verdicts came from
+        self.source = source
+
+    @classmethod
+    def from_probabilities(cls, probabilities: np.ndarray, source: str = '') -> 'VerdictTable':
+        verdicts = probabilities > 0.5
+        # confidence is the probability of the verdict that was given
+        return cls(verdicts, np.where(verdicts, probabilities, 1 - probabilities), source)
+
+    @classmethod
+    def load(cls, name: str) -> 'VerdictTable':
+        with np.load(verdicts_path(name)) as f:
+            # tables compiled before sources were recorded match no model
+            source = str(f['source']) if 'source' in f else None
+            return cls(np.unpackbits(f['verdicts'], count=len(SPACE)).astype(bool), f['confidence'], source)
+
+    @classmethod
+    def load_current(cls, name: str) -> Optional['VerdictTable']:
+        if not cls.exists(name):
+            return None
+        table = cls.load(name)
+        if table.source != RULE_SOURCE and table.source != model_fingerprint(name):
+            logging.warning(f'{name}.verdicts.npz was not compiled from the current {name}.torch, ignoring it. '
+                            f'Recompile it with "nn.py compile --name {name}".')
+            return None
+        return table
+
+    @staticmethod
+    def exists(name: str) -> bool:
+        return os.path.exists(verdicts_path(name))
+
+    def save(self, name: str):
+        np.savez_compressed(verdicts_path(name), verdicts=np.packbits(self.verdicts), confidence=self.confidence,
+                            source=np.array(self.source or ''))
+
+    def lookup(self, caterpillar: Caterpillar) -> Tuple[bool, float]:
+        rank = SPACE.rank(caterpillar)
+        if rank is None:
+            raise KeyError(f'{caterpillar} is not in the caterpillar space')
+        return bool(self.verdicts[rank]), float(self.confidence[rank])
+
+    def lookup_ranks(self, ranks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self.verdicts[ranks], self.confidence[ranks]